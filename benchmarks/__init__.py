@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for Divvy's hot paths: scanning folders, parsing files, loading PubMed IDs and rendering the index page.
+
+benchmarks.corpus generates synthetic UniProtKB flat files, benchmarks.run runs the benchmarks on them and saves the
+results as JSON. benchmarks.load measures the latency of the web app's routes under concurrent requests.
+This package is not installed with Divvy.
+"""
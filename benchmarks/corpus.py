@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Generate a synthetic corpus of UniProtKB flat files for benchmarking.
+
+The files look like those curators drop into Divvy's folders: entries with RN/RP/RC/RX/RA/RT/RL reference
+blocks, some of them LARGE SCALE, comment and feature lines, a sequence and a ``**ZA XYZ`` curator line.
+Output only depends on the parameters and the seed, so runs on different machines or at different times scan
+the same data.
+
+Usage::
+
+    python -m benchmarks.corpus path/to/folder --files 200 --entries 5 50
+
+"""
+import argparse
+import os
+import random
+
+
+CURATORS = ['ABC', 'DEF', 'GHI', 'JKL', 'MNO']
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+TISSUES = ['Brain', 'Liver', 'Kidney', 'Testis', 'Placenta', 'Lung']
+SMALL_SCALE_RP = ['FUNCTION.',
+                  'FUNCTION, AND SUBCELLULAR LOCATION.',
+                  'INTERACTION WITH {gene}, AND MUTAGENESIS OF SER-{pos}.',
+                  'PHOSPHORYLATION AT SER-{pos}.',
+                  'X-RAY CRYSTALLOGRAPHY (2.1 ANGSTROMS) OF {start}-{end}.',
+                  ]
+LARGE_SCALE_RP = ['NUCLEOTIDE SEQUENCE [LARGE SCALE MRNA].',
+                  'NUCLEOTIDE SEQUENCE [LARGE SCALE GENOMIC DNA].',
+                  'IDENTIFICATION BY MASS SPECTROMETRY [LARGE SCALE ANALYSIS].',
+                  'PHOSPHORYLATION [LARGE SCALE ANALYSIS] AT SER-{pos}, AND IDENTIFICATION BY MASS SPECTROMETRY '
+                  '[LARGE SCALE ANALYSIS].',
+                  ]
+
+
+class CorpusGenerator(object):
+    """Deterministically generate UniProtKB flat file entries.
+
+    Args:
+        seed (int): Seed of the random number generator.
+        pmids (int): Size of the pool of PubMed IDs references are drawn from. A smaller pool means more files
+            citing the same PubMed IDs.
+        large_scale (float): Share of references which are LARGE SCALE.
+    """
+    def __init__(self, seed=0, pmids=50000, large_scale=0.3):
+        self.random = random.Random(seed)
+        self.pmids = pmids
+        self.large_scale = large_scale
+        self.accessions = 0
+
+    def pmid(self):
+        return 10000000 + self.random.randrange(self.pmids)
+
+    def entry(self, curator, references=(3, 12), length=(80, 1200)):
+        """Return an entry as text, ending with a // line."""
+        rnd = self.random
+        self.accessions += 1
+        accession = 'Q{0:05d}'.format(self.accessions % 100000)
+        gene = 'GENE{}'.format(rnd.randrange(1, 30000))
+        seq_length = rnd.randint(*length)
+        lines = ['ID   {0}_HUMAN               Reviewed;        {1} AA.'.format(gene, seq_length),
+                 'AC   {};'.format(accession),
+                 'DT   01-OCT-1996, integrated into UniProtKB/Swiss-Prot.',
+                 'DE   RecName: Full=Protein {};'.format(gene),
+                 'GN   Name={};'.format(gene),
+                 'OS   Homo sapiens (Human).',
+                 'OC   Eukaryota; Metazoa; Chordata; Craniata; Vertebrata; Euteleostomi;',
+                 'OC   Mammalia; Eutheria; Euarchontoglires; Primates; Haplorrhini; Catarrhini; Hominidae; Homo.',
+                 'OX   NCBI_TaxID=9606;',
+                 ]
+        for number in range(1, rnd.randint(*references) + 1):
+            lines.extend(self.reference(number, gene, seq_length))
+        lines.extend(['CC   -!- FUNCTION: Plays a role in the regulation of {}.'.format(gene.lower()),
+                      'CC   -!- SUBCELLULAR LOCATION: Nucleus.',
+                      'DR   EMBL; AB{0:06d}; BAA{0:05d}.1; -; mRNA.'.format(rnd.randrange(1000000)),
+                      'PE   1: Evidence at protein level;',
+                      'KW   Nucleus; Phosphoprotein; Reference proteome.',
+                      'FT   CHAIN           1..{0}'.format(seq_length),
+                      'FT                   /note="Protein {}"'.format(gene),
+                      '**',
+                      '**   #################    INTERNAL SECTION    ##################',
+                      '**ZA {}'.format(curator),
+                      'SQ   SEQUENCE   {0} AA;  {1} MW;  {2:016X} CRC64;'.format(
+                          seq_length, seq_length * 110, rnd.getrandbits(64)),
+                      ])
+        sequence = ''.join(rnd.choice(AMINO_ACIDS) for _ in range(seq_length))
+        for start in range(0, seq_length, 60):
+            row = sequence[start:start + 60]
+            lines.append('     ' + ' '.join(row[idx:idx + 10] for idx in range(0, len(row), 10)))
+        lines.append('//')
+        return '\n'.join(lines) + '\n'
+
+    def reference(self, number, gene, seq_length):
+        rnd = self.random
+        pos = rnd.randint(1, seq_length)
+        fields = {'gene': gene, 'pos': pos, 'start': max(1, pos - 50), 'end': pos}
+        templates = LARGE_SCALE_RP if rnd.random() < self.large_scale else SMALL_SCALE_RP
+        lines = ['RN   [{}]'.format(number),
+                 'RP   {}'.format(rnd.choice(templates).format(**fields))]
+        if rnd.random() < 0.5:
+            lines.append('RC   TISSUE={};'.format(rnd.choice(TISSUES)))
+        lines.extend(['RX   PubMed={0}; DOI=10.1000/j.{0};'.format(self.pmid()),
+                      'RA   Smith J., Doe A., Mustermann M.;',
+                      'RT   "Characterization of {}.";'.format(gene),
+                      'RL   J. Biol. Chem. {0}:{1}-{2}({3}).'.format(rnd.randint(200, 300), pos, pos + 10,
+                                                                      rnd.randint(1990, 2020)),
+                      ])
+        return lines
+
+    def file_content(self, entries, curator=None):
+        """Return the content of a file with entries authored by one curator."""
+        curator = curator or self.random.choice(CURATORS)
+        return ''.join(self.entry(curator) for _ in range(entries))
+
+
+def write_corpus(directory, files=100, entries=(5, 50), seed=0, **kwargs):
+    """Write a corpus of flat files into a directory.
+
+    Args:
+        directory (str): Where to write the files; created if necessary.
+        files (int): Number of files.
+        entries (tuple): Minimum and maximum number of entries per file.
+        seed (int): Seed of the random number generator.
+        **kwargs: Passed on to CorpusGenerator.
+
+    Returns:
+        list: Paths of the written files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    generator = CorpusGenerator(seed=seed, **kwargs)
+    paths = []
+    for idx in range(files):
+        path = os.path.join(directory, 'batch{0:05d}.sp'.format(idx))
+        content = generator.file_content(generator.random.randint(*entries))
+        with open(path, 'w', encoding='utf8', newline='\n') as f:
+            f.write(content)
+        paths.append(path)
+    return paths
+
+
+def write_swissprot_dumps(directory, pmids=10000, seed=0):
+    """Write the same PubMed IDs in the txt, xml and rdf formats read by up2pmid.
+
+    Args:
+        directory (str): Where to write the files; created if necessary.
+        pmids (int): Number of PubMed IDs.
+        seed (int): Seed of the random number generator.
+
+    Returns:
+        dict: Format mapped to the path of the written file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rnd = random.Random(seed)
+    ids = [10000000 + rnd.randrange(50000) for _ in range(pmids)]
+    templates = {'txt': 'RN   [1]\nRP   FUNCTION.\nRX   PubMed={0}; DOI=10.1000/j.{0};\n//\n',
+                 'xml': '<reference key="1">\n<citation type="journal article">\n'
+                        '<dbReference type="PubMed" id="{0}"/>\n</citation>\n</reference>\n',
+                 'rdf': '<rdf:Description rdf:about="http://purl.uniprot.org/uniprot/Q{0}">\n'
+                        '<citation rdf:resource="http://purl.uniprot.org/citations/{0}"/>\n</rdf:Description>\n',
+                 }
+    paths = {}
+    for fmt, template in templates.items():
+        paths[fmt] = os.path.join(directory, 'swissprot.{}'.format(fmt))
+        with open(paths[fmt], 'w', encoding='utf8', newline='\n') as f:
+            f.writelines(template.format(pmid) for pmid in ids)
+    return paths
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description='Write synthetic UniProtKB flat files.')
+    parser.add_argument('directory', help='folder to write the files to')
+    parser.add_argument('-n', '--files', type=int, default=100, help='number of files')
+    parser.add_argument('-e', '--entries', type=int, nargs=2, default=(5, 50), metavar=('MIN', 'MAX'),
+                        help='number of entries per file')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the random number generator')
+    args = parser.parse_args()
+    paths = write_corpus(args.directory, args.files, tuple(args.entries), args.seed)
+    print('{0} files written to {1}'.format(len(paths), args.directory))
+
+
+if __name__ == '__main__':
+    main()
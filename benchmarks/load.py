@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""Load-test Divvy's web app over HTTP.
+
+Divvy is served by waitress from a scratch directory holding a synthetic corpus (see benchmarks.corpus) and a DB
+scanned from it. Clients then request the index page, /refresh, /_log_files and the admin lists for a while and
+the throughput and latency of each route are reported. /_log_files adds its comments to a stub Jira served locally.
+
+Clients run in a process of their own so that they do not compete with the server for the GIL. With --burst,
+all clients send a request at the same moment every few seconds, as when everybody opens Divvy on a Thursday.
+Several waitress thread counts can be compared in one run, optionally while scans keep running.
+
+Usage::
+
+    python -m benchmarks.load --threads 2 4 8 --clients 16 --duration 20 --scan -o load.json
+
+"""
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+from benchmarks.corpus import CorpusGenerator
+
+
+LOG_FILES_QUERY = quote(json.dumps({'timestamp': '2016-05-12 14:22', 'Alice': ['batch00000.sp', 'batch00001.sp']}))
+
+# Route name mapped to method, path and share of requests
+ROUTES = OrderedDict([('index', ('GET', '/', 50)),
+                      ('refresh', ('POST', '/refresh', 5)),
+                      ('log_files', ('GET', '/_log_files?files=' + LOG_FILES_QUERY, 5)),
+                      ('admin_files', ('GET', '/admin/file/', 10)),
+                      ('admin_references', ('GET', '/admin/reference/', 10)),
+                      ])
+
+
+class StubJira(object):
+    """Answer the requests jira.JIRA makes to add a comment, after a delay.
+
+    Args:
+        delay (float): Seconds to wait before answering, as a remote Jira would.
+    """
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.comments = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.endswith('/serverInfo'):
+                    stub.reply(self, 200, {'version': '8.0.0', 'versionNumbers': [8, 0, 0],
+                                           'deploymentType': 'Server'})
+                else:
+                    stub.reply(self, 404, {})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not self.path.endswith('/comment'):
+                    stub.reply(self, 404, {})
+                    return
+                with stub._lock:
+                    stub.comments += 1
+                    number = stub.comments
+                stub.reply(self, 201, {'id': str(number), 'body': json.loads(body or b'{}').get('body', '')})
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def reply(self, handler, status, data):
+        time.sleep(self.delay)
+        body = json.dumps(data).encode('utf8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='stub-jira', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Churn(object):
+    """Keep scanning while files change, as curators save files during QA.
+
+    Before each scan, entries are appended to a tenth of the files in turn.
+    """
+    def __init__(self, ws, seed):
+        self.ws = ws
+        self.generator = CorpusGenerator(seed=seed + 1)
+        self.scans = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='churn', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        paths = self.ws.paths
+        step = max(1, len(paths) // 10)
+        offset = 0
+        while not self._stop.is_set():
+            for path in paths[offset:offset + step]:
+                with open(path, 'a', encoding='utf8', newline='\n') as f:
+                    f.write(self.generator.entry('ABC'))
+            offset = (offset + step) % len(paths)
+            self.ws.jobs.scan_now(timeout=None)
+            self.scans += 1
+
+
+def drive(port, routes, clients, duration, burst_every, seed, headers=None):
+    """Send requests from client threads for a while. Runs in the client process.
+
+    Args:
+        port (int): Port Divvy is served on.
+        routes (dict): Route name mapped to method, path and share of requests.
+        clients (int): Number of client threads, each with one connection.
+        duration (float): Seconds to send requests for.
+        burst_every (float): If set, all clients send a request together every this many seconds. Otherwise
+            each client sends its next request as soon as it got the answer to the last one.
+        seed (int): Seed of the random choice of routes.
+        headers (dict): Headers sent with each request, e.g. Accept-Encoding.
+
+    Returns:
+        tuple: Seconds requests were sent for and a list of route name, latency and status (None on
+            connection errors) of each request.
+    """
+    names = list(routes)
+    weights = [routes[name][2] for name in names]
+    samples = []
+    start = time.monotonic()
+    deadline = start + duration
+
+    def client(number):
+        rnd = random.Random(seed + number)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        while True:
+            if burst_every:
+                time.sleep(burst_every - (time.monotonic() - start) % burst_every)
+            if time.monotonic() >= deadline:
+                break
+            name = rnd.choices(names, weights)[0]
+            method, path, _ = routes[name]
+            sent = time.perf_counter()
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = None
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+            samples.append((name, time.perf_counter() - sent, status))
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - start, samples
+
+
+def percentile(values, share):
+    """Return the nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+
+def summarize(samples, seconds):
+    """Summarize requests per route and overall.
+
+    Returns:
+        OrderedDict: Route name, and 'total', mapped to number of requests, errors, requests per second and
+            50th, 95th and 99th percentile and highest latency in milliseconds.
+    """
+    by_route = OrderedDict((name, []) for name in ROUTES)
+    for name, latency, status in samples:
+        by_route.setdefault(name, []).append((latency, status))
+    by_route['total'] = [(latency, status) for _, latency, status in samples]
+    summary = OrderedDict()
+    for name, results in by_route.items():
+        if not results:
+            continue
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        summary[name] = {'requests': len(results),
+                         'errors': sum(1 for _, status in results if status is None or status >= 500),
+                         'rps': len(results) / seconds,
+                         'p50': percentile(latencies, 0.5),
+                         'p95': percentile(latencies, 0.95),
+                         'p99': percentile(latencies, 0.99),
+                         'max': latencies[-1],
+                         }
+    return summary
+
+
+def print_summary(threads, summary):
+    print('\nwaitress threads: {}'.format(threads))
+    print('{0:<18}{1:>9}{2:>7}{3:>9}{4:>10}{5:>10}{6:>10}{7:>10}'.format(
+        'route', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'max (ms)'))
+    for name, row in summary.items():
+        print('{0:<18}{1[requests]:>9}{1[errors]:>7}{1[rps]:>9.1f}{1[p50]:>10.1f}{1[p95]:>10.1f}'
+              '{1[p99]:>10.1f}{1[max]:>10.1f}'.format(name, row))
+
+
+def compare(results, previous):
+    """Print how the 95th percentile latency changed compared to an earlier run with the same thread counts."""
+    before = {run['threads']: run['routes'] for run in previous.get('runs', [])}
+    print('\n{0:<9}{1:<18}{2:>12}{3:>12}{4:>9}'.format('threads', 'route', 'p95 before', 'p95 now', 'change'))
+    for run in results['runs']:
+        for name, row in run['routes'].items():
+            then = before.get(run['threads'], {}).get(name)
+            if then is None:
+                continue
+            change = row['p95'] / then['p95'] - 1 if then['p95'] else 0
+            print('{0:<9}{1:<18}{2:>12.1f}{3:>12.1f}{4:>+9.1%}'.format(run['threads'], name, then['p95'], row['p95'],
+                                                                       change))
+
+
+def serve(app, threads):
+    """Serve the app with waitress in a background thread.
+
+    Returns:
+        TcpWSGIServer: The server; close it and shut down its task dispatcher to stop it.
+    """
+    from waitress import create_server
+    # Waitress warns whenever requests wait for a thread, which they do under load.
+    logging.getLogger('waitress.queue').setLevel(logging.ERROR)
+    server = create_server(app, host='127.0.0.1', port=0, threads=threads,
+                           connection_limit=app.config['WAITRESS_CONNECTION_LIMIT'],
+                           backlog=app.config['WAITRESS_BACKLOG'])
+    threading.Thread(target=server.run, name='waitress', daemon=True).start()
+    return server
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description="Load-test Divvy's web app.")
+    parser.add_argument('-o', '--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file with results of an earlier run')
+    parser.add_argument('-t', '--threads', type=int, nargs='+', default=[4], help='waitress thread counts to try')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds of load per thread count')
+    parser.add_argument('--burst', type=float, default=0, metavar='SECONDS',
+                        help='send requests from all clients together every SECONDS instead of back to back')
+    parser.add_argument('--scan', action='store_true', help='keep scanning changing files during the load')
+    parser.add_argument('--accept-encoding', help='Accept-Encoding header to send, e.g. gzip')
+    parser.add_argument('--jira-delay', type=float, default=0.2, help='seconds the stub Jira takes to answer')
+    parser.add_argument('-n', '--files', type=int, default=100, help='number of files in the corpus')
+    parser.add_argument('-e', '--entries', type=int, nargs=2, default=(5, 50), metavar=('MIN', 'MAX'),
+                        help='number of entries per file')
+    parser.add_argument('--pmids', type=int, default=1000, help='number of PubMed IDs in the Swiss-Prot dumps')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the corpus generator and the clients')
+    parser.add_argument('--log-level', default='ERROR', help="level of Divvy's log during the load")
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            previous = json.load(f)
+    cwd = os.getcwd()
+    root = tempfile.mkdtemp(prefix='divvy-load-')
+    ws = None
+    headers = {'Accept-Encoding': args.accept_encoding} if args.accept_encoding else None
+    jira = StubJira(args.jira_delay)
+    jira.start()
+    # Clients do not import Divvy, so spawning their process is cheap.
+    clients = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        from benchmarks.run import Workspace
+        ws = Workspace(root, args)
+        from divvy.admin import setup_admin
+        from divvy.version import __version__
+        app = ws.app
+        setup_admin(app)
+        app.config.update(JIRA_URL=jira.url, JIRA_USER='load', JIRA_PWD='load', JIRA_ISSUE='LOAD-1')
+        ws.reset_db()
+        ws.jobs.scan_folders()
+        results = {'divvy': __version__,
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'parameters': {'files': args.files, 'entries': list(args.entries), 'clients': args.clients,
+                                  'duration': args.duration, 'burst': args.burst, 'scan': args.scan,
+                                  'accept_encoding': args.accept_encoding, 'jira_delay': args.jira_delay,
+                                  'seed': args.seed},
+                   'runs': [],
+                   }
+        for threads in args.threads:
+            server = serve(app, threads)
+            churn = Churn(ws, args.seed) if args.scan else None
+            comments = jira.comments
+            try:
+                if churn is not None:
+                    churn.start()
+                seconds, samples = clients.submit(drive, int(server.effective_port), ROUTES, args.clients,
+                                                  args.duration, args.burst, args.seed, headers).result()
+            finally:
+                if churn is not None:
+                    churn.stop()
+                server.close()
+                server.task_dispatcher.shutdown()
+            summary = summarize(samples, seconds)
+            results['runs'].append({'threads': threads,
+                                    'routes': summary,
+                                    'scans': churn.scans if churn is not None else 0,
+                                    'jira_comments': jira.comments - comments,
+                                    })
+            print_summary(threads, summary)
+            if churn is not None:
+                print('{} scans during the load'.format(churn.scans))
+    finally:
+        clients.shutdown()
+        jira.stop()
+        os.chdir(cwd)
+        if ws is not None:
+            ws.log_listener.stop()
+        logging.shutdown()
+        if args.keep:
+            print('Scratch directory kept: {}'.format(root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    if output:
+        with open(output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved to {}'.format(output))
+    if previous is not None:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""Run Divvy's benchmarks and save the results as JSON.
+
+Everything happens in a scratch directory: the synthetic corpus (see benchmarks.corpus), the DB and the log file.
+Results of earlier runs can be passed with --compare to see how timings changed.
+
+Usage::
+
+    python -m benchmarks.run --files 200 -o results.json --compare previous.json
+
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from benchmarks.corpus import CorpusGenerator, write_corpus, write_swissprot_dumps
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Register a benchmark. Benchmarks are run in the order they are defined."""
+    BENCHMARKS.append(func)
+    return func
+
+
+def measure(func, setup=None, repeat=5):
+    """Time a function.
+
+    Args:
+        func (callable): What to time.
+        setup (callable): Called before each run without being timed.
+        repeat (int): Number of runs.
+
+    Returns:
+        dict: Fastest, median and mean run in seconds and the number of runs.
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {'min': min(timings),
+            'median': statistics.median(timings),
+            'mean': statistics.mean(timings),
+            'runs': repeat,
+            }
+
+
+class Workspace(object):
+    """Corpus, DB and Divvy modules shared by the benchmarks.
+
+    Divvy's app is set up only once the working directory has been changed to the scratch directory, as setting
+    it up creates the log file in the working directory.
+    """
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.folder = os.path.join(root, 'folder')
+        self.paths = write_corpus(self.folder, args.files, tuple(args.entries), args.seed)
+        self.nbytes = sum(os.path.getsize(p) for p in self.paths)
+        self.dumps = write_swissprot_dumps(os.path.join(root, 'swissprot'), args.pmids, args.seed)
+        os.chdir(root)
+        from divvy import app, db, log_listener
+        from divvy import jobs, models
+        import divvy.views
+        self.app = app
+        self.db = db
+        self.jobs = jobs
+        self.models = models
+        self.log_listener = log_listener
+        app.logger.setLevel(args.log_level)
+        app.config['DATABASE_URI'] = os.path.join(root, 'benchmark.sqlite')
+        app.config['OLD_PMIDS_FILE'] = os.path.join(root, 'pmids_in_swissprot.txt')
+        app.config['SCAN_TIME_BUDGET'] = None
+        app.config['SCAN_BYTE_BUDGET'] = None
+        app.config['LEADER_ELECTION'] = False
+        with open(app.config['OLD_PMIDS_FILE'], 'w', encoding='utf8') as f:
+            f.writelines('{}\n'.format(10000000 + idx) for idx in range(0, 50000, 3))
+        db.init(app.config['DATABASE_URI'])
+
+    def reset_db(self):
+        """Start from an empty DB with curators and the corpus folder, forgetting earlier surveys."""
+        models = self.models
+        tables = [models.Curator, models.Folder, models.File, models.Pmid, models.Reference,
+                  models.ScanJournal, models.ParseCache, models.ScanState, models.Lease, models.ScanTask]
+        self.db.drop_tables(tables)
+        models.init_db()
+        for initials in ['ABC', 'DEF', 'GHI', 'JKL', 'MNO']:
+            models.Curator.create(surname=initials, given_name=initials, initial=initials, checker=True)
+        models.Folder.create(path=self.folder)
+        self.reset_surveys()
+
+    def reset_scan_data(self):
+        """Drop file and reference data but keep the parse cache."""
+        models = self.models
+        self.db.drop_tables([models.File, models.Pmid, models.Reference, models.ScanJournal])
+        models.init_db()
+        self.reset_surveys()
+
+    def reset_surveys(self):
+        self.jobs._reset_surveys()
+        self.jobs.ENTRY_INDEX.clear()
+        self.app.config.pop('OLD_PMIDS', None)
+
+
+@benchmark
+def scan_cold(ws):
+    """Scan the whole corpus into an empty DB."""
+    return measure(ws.jobs.scan_folders, setup=ws.reset_db, repeat=ws.args.repeat), {'files': len(ws.paths),
+                                                                                  'bytes': ws.nbytes}
+
+
+@benchmark
+def scan_warm(ws):
+    """Scan the whole corpus into a DB without file data but with all parse results cached."""
+    ws.reset_db()
+    ws.jobs.scan_folders()
+    return measure(ws.jobs.scan_folders, setup=ws.reset_scan_data, repeat=ws.args.repeat), {'files': len(ws.paths)}
+
+
+@benchmark
+def scan_unchanged(ws):
+    """Scan a folder which has not changed since the last scan."""
+    ws.reset_db()
+    ws.jobs.scan_folders()
+    return measure(ws.jobs.scan_folders, repeat=ws.args.repeat), {'files': len(ws.paths)}
+
+
+@benchmark
+def scan_incremental(ws):
+    """Scan after a tenth of the files have been edited in place and as many have been added."""
+    ws.reset_db()
+    ws.jobs.scan_folders()
+    generator = CorpusGenerator(seed=ws.args.seed + 1)
+    changed = ws.paths[::10]
+    added = [os.path.join(ws.folder, 'added{0:05d}.sp'.format(idx)) for idx in range(len(changed))]
+
+    def edit():
+        for path in changed:
+            with open(path, 'a', encoding='utf8', newline='\n') as f:
+                f.write(generator.entry('ABC'))
+        for path in added:
+            with open(path, 'w', encoding='utf8', newline='\n') as f:
+                f.write(generator.file_content(10))
+
+    def remove_added():
+        for path in added:
+            if os.path.exists(path):
+                os.remove(path)
+        ws.jobs.scan_folders()
+
+    def setup():
+        remove_added()
+        edit()
+
+    try:
+        result = measure(ws.jobs.scan_folders, setup=setup, repeat=ws.args.repeat)
+    finally:
+        for path in added:
+            if os.path.exists(path):
+                os.remove(path)
+    return result, {'changed': len(changed), 'added': len(added)}
+
+
+@benchmark
+def extract_pmids(ws):
+    """Parse the largest file of the corpus and split its PubMed IDs into new and known ones."""
+    jobs = ws.jobs
+    ws.reset_db()
+    ws.jobs._load_swissprot_pubmed_ids()
+    path = max(ws.paths, key=os.path.getsize)
+    record = jobs.FileRecord(path, ws.folder)
+
+    def setup():
+        record.parsed = None
+        jobs.ENTRY_INDEX.clear()
+        ws.models.ParseCache.delete().execute()
+
+    result = measure(lambda: jobs._extract_pmids(record), setup=setup, repeat=ws.args.repeat * 4)
+    return result, {'bytes': os.path.getsize(path), 'entries': record.parsed.entry_count}
+
+
+@benchmark
+def read_old_pmids(ws):
+    """Load the PubMed IDs cited in Swiss-Prot and flag them in the Pmid table."""
+    ws.reset_db()
+    ws.jobs.scan_folders()
+    return measure(ws.models.read_old_pmids, repeat=ws.args.repeat), {}
+
+
+@benchmark
+def up2pmid(ws):
+    """Extract PubMed IDs from Swiss-Prot dumps in each format."""
+    from divvy.up2pmid import extract_pmids
+    results = {}
+    for fmt, path in sorted(ws.dumps.items()):
+        results[fmt] = measure(lambda: extract_pmids([path], fmt), repeat=ws.args.repeat)
+    return results, {'bytes': {fmt: os.path.getsize(path) for fmt, path in ws.dumps.items()}}
+
+
+@benchmark
+def index_view(ws):
+    """Render the index page for a DB holding the whole corpus."""
+    ws.reset_db()
+    ws.jobs.scan_folders()
+    client = ws.app.test_client()
+
+    def render():
+        response = client.get('/')
+        assert response.status_code == 200, response.status_code
+
+    return measure(render, repeat=ws.args.repeat * 4), {}
+
+
+def compare(results, previous):
+    """Print how the median timings changed compared to an earlier run."""
+    print('\n{0:<20}{1:>12}{2:>12}{3:>9}'.format('benchmark', 'before (s)', 'now (s)', 'change'))
+    for name, result in results['benchmarks'].items():
+        before = previous.get('benchmarks', {}).get(name)
+        if before is None:
+            continue
+        timings = result['timings']
+        pairs = ([(name, timings, before['timings'])] if 'median' in timings else
+                 [('{0}.{1}'.format(name, key), value, before['timings'].get(key)) for key, value in timings.items()])
+        for label, now, then in pairs:
+            if then is None:
+                continue
+            change = now['median'] / then['median'] - 1 if then['median'] else 0
+            print('{0:<20}{1:>12.4f}{2:>12.4f}{3:>+9.1%}'.format(label, then['median'], now['median'], change))
+
+
+def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(description="Run Divvy's benchmarks.")
+    parser.add_argument('-o', '--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file with results of an earlier run')
+    parser.add_argument('-n', '--files', type=int, default=100, help='number of files in the corpus')
+    parser.add_argument('-e', '--entries', type=int, nargs=2, default=(5, 50), metavar=('MIN', 'MAX'),
+                        help='number of entries per file')
+    parser.add_argument('--pmids', type=int, default=100000, help='number of PubMed IDs in the Swiss-Prot dumps')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per benchmark')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the corpus generator')
+    parser.add_argument('-k', '--only', nargs='*', help='names of the benchmarks to run')
+    parser.add_argument('--log-level', default='ERROR', help="level of Divvy's log during the benchmarks")
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf8') as f:
+            previous = json.load(f)
+    cwd = os.getcwd()
+    root = tempfile.mkdtemp(prefix='divvy-bench-')
+    ws = None
+    try:
+        ws = Workspace(root, args)
+        from divvy.version import __version__
+        results = {'divvy': __version__,
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'parameters': {'files': args.files, 'entries': list(args.entries), 'pmids': args.pmids,
+                                  'seed': args.seed, 'repeat': args.repeat},
+                   'benchmarks': {},
+                   }
+        for func in BENCHMARKS:
+            if args.only and func.__name__ not in args.only:
+                continue
+            timings, info = func(ws)
+            results['benchmarks'][func.__name__] = {'description': func.__doc__, 'timings': timings, 'info': info}
+            median = timings['median'] if 'median' in timings else sum(x['median'] for x in timings.values())
+            print('{0:<20}{1:>10.4f} s'.format(func.__name__, median))
+            sys.stdout.flush()
+    finally:
+        os.chdir(cwd)
+        if ws is not None:
+            # Write out queued log records before the log file is closed.
+            ws.log_listener.stop()
+        logging.shutdown()
+        if args.keep:
+            print('Scratch directory kept: {}'.format(root))
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    if output:
+        with open(output, 'w', encoding='utf8') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved to {}'.format(output))
+    if previous is not None:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,29 +8,43 @@ Created on Thu May 12 14:22:01 2016
 
 @author: kp14
 """
-import logging
-from logging.handlers import RotatingFileHandler
 import os
-import peewee
-from flask import Flask
-from .util import get_jira_credentials
+import threading
 
 
-app = Flask(__name__)
-run_status = os.environ.get('DIVVY_RUN', 'Development')
-app.config.from_object('divvy.config.{}'.format(run_status))
+# app, db and log_listener are only set up on first access, see __getattr__. Importing a module of the package,
+# e.g. for the up2pmid script, thus neither loads Flask nor creates the log file.
+_LAZY = ('app', 'db', 'log_listener')
+_lock = threading.Lock()
 
-get_jira_credentials(app)
 
-app.logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter(app.config['LOG_FORMAT'])
-handler = RotatingFileHandler(app.config['LOG_FILE'],
-                              maxBytes=app.config['LOG_MAXBYTES'],
-                              backupCount=app.config['LOG_BACKUP_COUNT'])
-handler.setLevel(app.config['LOG_LEVEL'])
-handler.setFormatter(formatter)
-app.logger.addHandler(handler)
+def _setup():
+    """Create the Flask app, its log and the DB object."""
+    global app, db, log_listener
+    from flask import Flask
+    from divvy.database import DivvyDatabase
+    from divvy.logs import setup_logging
 
+    app = Flask(__name__)
+    run_status = os.environ.get('DIVVY_RUN', 'Development')
+    app.config.from_object('divvy.config.{}'.format(run_status))
+    # A settings file named by DIVVY_SETTINGS overrides the defaults; it is read before the log and DB are set up.
+    if os.environ.get('DIVVY_SETTINGS'):
+        app.config.from_envvar('DIVVY_SETTINGS')
 
-db = peewee.SqliteDatabase(app.config['DATABASE_URI'], check_same_thread=False, pragmas=(('foreign_keys', 'on'),))
+    log_listener = setup_logging(app)
 
+    pragmas = [('foreign_keys', 'on')]
+    if app.config['SHADOW_REBUILD']:
+        # Readers see the last committed state without waiting for the writer.
+        pragmas.append(('journal_mode', 'wal'))
+    db = DivvyDatabase(app.config['DATABASE_URI'], check_same_thread=False, pragmas=pragmas)
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+    with _lock:
+        if name not in globals():
+            _setup()
+    return globals()[name]
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides divvy's admin panel.
+
+It is only imported by the web server, so that scanner workers and command line scripts do not load flask_admin.
+"""
+from flask import abort, flash, redirect, request, send_from_directory, url_for
+from flask_admin import Admin, BaseView, expose
+from flask_admin.contrib.peewee import ModelView
+from flask_admin.contrib.peewee.filters import FilterEqual
+import peewee
+from divvy import app
+from divvy.models import Curator, File, Folder, Pmid, Reference, new_generation
+from divvy.profiling import PROFILER, Profiler, list_profiles, profile_dir, summarize
+from divvy.util import is_debug_client
+
+
+class DataView(ModelView):
+    """ModelView starting a new data generation on every change, so that browsers reload the index page."""
+    def after_model_change(self, form, model, is_created):
+        new_generation()
+
+    def after_model_delete(self, model):
+        new_generation()
+
+
+class CuratorAdmin(DataView):
+    pass
+
+
+class FolderAdmin(DataView):
+    pass
+
+
+class PmidAdmin(DataView):
+    pass
+
+
+class LargeTableView(DataView):
+    """List view for tables too large to be listed or counted row by row.
+
+    get_query joins the rows shown alongside each row, e.g. a file's curator, so they are not fetched one row
+    at a time while the list is rendered. Columns of the models in joined_models can then be sorted and filtered
+    on without joining them again.
+
+    Unfiltered lists are counted on the table alone. Filtered ones are counted unless ADMIN_APPROXIMATE_COUNT is set,
+    in which case unfiltered lists are counted by the highest ID and filtered lists only get previous/next links.
+    """
+    page_size = 50
+    can_set_page_size = True
+    page_size_options = (20, 50, 100, 500)
+    # The count is worked out in get_list.
+    simple_list_pager = True
+    joined_models = ()
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        _, query = super(LargeTableView, self).get_list(page, sort_column, sort_desc, search, filters,
+                                                        execute=False, page_size=page_size)
+        count = self._count(query.order_by().limit(None).offset(None), bool(search or filters))
+        if execute:
+            query = list(query.execute())
+        return count, query
+
+    def _count(self, query, filtered):
+        approximate = app.config['ADMIN_APPROXIMATE_COUNT']
+        if not filtered:
+            if approximate:
+                # Rows are inserted with increasing IDs and rarely deleted.
+                return self.model.select(peewee.fn.MAX(self.model._meta.primary_key)).scalar() or 0
+            return self.model.select().count()
+        return None if approximate else query.count()
+
+    def _handle_join(self, query, field, joins):
+        joins.update(model.__name__ for model in self.joined_models)
+        return super(LargeTableView, self)._handle_join(query, field, joins)
+
+
+class FileAdmin(LargeTableView):
+    joined_models = (Curator, Folder)
+    column_list = ('filename', 'entry_count', 'resubmission', 'curator.initial', 'folder.path')
+    column_labels = {'curator.initial': 'Curator', 'folder.path': 'Folder'}
+    column_sortable_list = ('filename', 'entry_count', 'resubmission', ('curator.initial', Curator.initial),
+                            ('folder.path', Folder.path))
+    column_searchable_list = (File.filename,)
+    column_filters = (File.filename, File.resubmission, FilterEqual(Curator.initial, 'Curator'), Folder.path)
+
+    def get_query(self):
+        return (File
+                .select(File, Curator, Folder)
+                .join(Curator)
+                .switch(File)
+                .join(Folder)
+                .switch(File))
+
+
+class ReferenceAdmin(LargeTableView):
+    joined_models = (Pmid, File, Curator, Folder)
+    column_list = ('pmid', 'pmid.in_swissprot', 'sourcefile.filename', 'sourcefile.curator.initial',
+                   'sourcefile.folder.path')
+    column_labels = {'pmid': 'PubMed ID',
+                     'pmid.in_swissprot': 'In Swiss-Prot',
+                     'sourcefile.filename': 'File',
+                     'sourcefile.curator.initial': 'Curator',
+                     'sourcefile.folder.path': 'Folder',
+                     }
+    column_sortable_list = (('pmid', Reference.pmid), ('sourcefile.filename', File.filename),
+                            ('sourcefile.curator.initial', Curator.initial))
+    column_filters = (Pmid.id, Pmid.in_swissprot, File.filename, File.resubmission,
+                      FilterEqual(Curator.initial, 'Curator'), Folder.path)
+
+    def get_query(self):
+        return (Reference
+                .select(Reference, Pmid, File, Curator, Folder)
+                .join(Pmid)
+                .switch(Reference)
+                .join(File)
+                .join(Curator)
+                .switch(File)
+                .join(Folder)
+                .switch(Reference))
+
+
+class ProfilingAdmin(BaseView):
+    """Admin view to arm the profiler and to list, view and download results.
+
+    Only clients listed in DEBUG_CLIENTS may see it.
+    """
+    def is_accessible(self):
+        return is_debug_client(app)
+
+    @expose('/')
+    def index(self):
+        return self.render('admin/profiling.html', profiler=PROFILER, profiles=list_profiles())
+
+    @expose('/arm', methods=['POST'])
+    def arm(self):
+        kind = request.form.get('kind')
+        if kind not in Profiler.kinds:
+            abort(400)
+        try:
+            count = max(0, int(request.form.get('count', 1)))
+        except ValueError:
+            abort(400)
+        memory = bool(request.form.get('memory'))
+        PROFILER.arm(kind, count, memory)
+        flash('Profiling the next {0} {1}s{2}.'.format(count, kind, ' with tracemalloc' if memory else ''),
+              'alert alert-info')
+        return redirect(url_for('.index'))
+
+    @expose('/disarm', methods=['POST'])
+    def disarm(self):
+        PROFILER.disarm()
+        flash('Profiling stopped.', 'alert alert-info')
+        return redirect(url_for('.index'))
+
+    @expose('/view/<filename>')
+    def view(self, filename):
+        if filename not in list_profiles():
+            abort(404)
+        return self.render('admin/profile.html', filename=filename, summary=summarize(filename))
+
+    @expose('/download/<filename>')
+    def download(self, filename):
+        if filename not in list_profiles():
+            abort(404)
+        return send_from_directory(profile_dir(), filename, as_attachment=True)
+
+
+# Lets admin/index.html offer profiling only to clients which may use it
+app.add_template_global(lambda: is_debug_client(app), 'is_debug_client')
+
+
+def setup_admin(app):
+    """Add the admin panel to the app.
+
+    Returns:
+        Admin: The admin panel.
+    """
+    panel = Admin(app, name='Divvy:admin')
+    panel.add_view(CuratorAdmin(Curator))
+    panel.add_view(FolderAdmin(Folder))
+    panel.add_view(FileAdmin(File))
+    panel.add_view(PmidAdmin(Pmid))
+    panel.add_view(ReferenceAdmin(Reference))
+    panel.add_view(ProfilingAdmin(name='Profiling', endpoint='profiling'))
+    return panel
@@ -29,19 +29,81 @@ class Config(object):
     PORT = 7999
     LOG_FORMAT = '[%(asctime)s] %(levelname)s - %(message)s {%(pathname)s:%(lineno)d}'
     LOG_FILE = 'divvy.log'
-    LOG_MAXBYTES = 100000
-    LOG_BACKUP_COUNT = 1
+    LOG_MAXBYTES = 10 * 1024 * 1024
+    LOG_BACKUP_COUNT = 3
     LOG_LEVEL = logging.DEBUG
+    # Write the log as JSON lines instead of in LOG_FORMAT
+    LOG_JSON = False
+    # Messages logged per file, e.g. for each file surveyed, are logged this many times per scan and then summarized
+    LOG_SAMPLE_LIMIT = 20
     JOBS = [
         {
             'id': 'job1',
-            'func': 'divvy.jobs:scan_folders',
+            'func': 'divvy.jobs:scheduled_scan',
             # 'args': (1, 2),
             'trigger': 'interval',
-            'seconds': 20
+            'seconds': 5,
+            'max_instances': 1,
+            'coalesce': True,
         }
     ]
+    SCAN_INTERVAL_MIN = 20
+    SCAN_INTERVAL_MAX = 300
+    SCAN_BACKOFF = 1.5
+    SCAN_DURATION_FACTOR = 3
+    SCAN_TIME_BUDGET = None
+    SCAN_BYTE_BUDGET = None
+    SCAN_CHECKPOINT_FILES = 50
+    SCAN_RESUME = True
+    PARSE_CACHE_SIZE = 20000
+    ENTRY_INDEX_FILES = 2000
+    SCAN_PRIORITY = 'newest'
+    SCAN_SKIP_UNCHANGED_DIRS = True
+    SCAN_FULL_SURVEY_SECONDS = 600
+    SCAN_IO_WORKERS = 4
+    SCAN_PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+    # Per-folder scan options keyed by Folder path, e.g.
+    # {'/qa/new': {'priority': 'oldest', 'recursive': True, 'include': ['*.sp'], 'exclude': ['*~']}}
+    SCAN_FOLDER_OPTIONS = {}
     SCHEDULER_API_ENABLED = True
+    # Set to False when a separate divvy-scanner process does the scanning
+    SCAN_IN_WEB = True
+    LEADER_ELECTION = True
+    LEADER_LEASE_SECONDS = 30
+    REFRESH_TIMEOUT = 30
+    # 'single': the leader scans all folders; 'queue': the leader enqueues a task per folder which any number of
+    # scanner workers claim
+    SCAN_MODE = 'single'
+    TASK_LEASE_SECONDS = 300
+    SCAN_TASK_ATTEMPTS = 3
+    # Rebuild file and reference data in a shadow DB file and swap them in at once instead of dropping the tables
+    # at startup; also puts the DB in WAL mode
+    SHADOW_REBUILD = False
+    # Addresses of clients allowed to use profiling in the admin panel and /_debug/queries. Behind a reverse proxy on
+    # the same host, every client has the proxy's address, so leave this empty there.
+    DEBUG_CLIENTS = ('127.0.0.1', '::1')
+    # Where profiles of scans and requests armed in the admin panel are written to
+    PROFILE_DIR = 'profiles'
+    # Record the SQL statements of each request and scan, see /_debug/queries (for DEBUG_CLIENTS only)
+    SQL_INSTRUMENTATION = False
+    SQL_SLOW_QUERY_SECONDS = 0.1
+    # Statements of the same shape run this often for one request or scan are reported as N+1 queries
+    SQL_REPEATED_QUERY_THRESHOLD = 20
+    # Count rows in the admin's File and Reference lists by their highest ID, and not at all when filtered
+    ADMIN_APPROXIMATE_COUNT = False
+    # Compress responses of these types with brotli (if installed) or gzip, as accepted by the client
+    COMPRESS_MIMETYPES = ['text/html', 'application/json', 'text/csv', 'text/plain', 'text/css',
+                          'application/javascript']
+    # Responses smaller than this many bytes are sent as they are
+    COMPRESS_MIN_SIZE = 500
+    GZIP_LEVEL = 6
+    BROTLI_QUALITY = 5
+    # Seconds browsers may keep static files requested with a fingerprint, see divvy.responses
+    STATIC_MAX_AGE = 365 * 24 * 3600
+    # Worker threads, open connections and queued connections of the waitress server started by run_divvy.py
+    WAITRESS_THREADS = 4
+    WAITRESS_CONNECTION_LIMIT = 100
+    WAITRESS_BACKLOG = 1024
     VERSION = __version__
 
 
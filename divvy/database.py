@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides the SQLite database class used by divvy.
+
+Besides what peewee offers, it lets a single thread work on a shadow copy of the DB file, e.g. to rebuild file and
+reference data from scratch while other threads keep reading the live DB (see jobs.rebuild_scan_data). It can
+also record the SQL statements a thread executes, e.g. for a request or a scan (see QueryLog).
+"""
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import datetime
+import re
+import sqlite3
+import threading
+import time
+import peewee
+
+
+# Lists of parameters, e.g. in IN clauses, vary in length but not in shape.
+_PARAMETER_LIST = re.compile(r'\(\?(?:, \?)*\)')
+
+
+class QueryLog(object):
+    """Record the SQL statements executed for a request or a scan, grouped by shape.
+
+    Statements of the same shape only differ in their parameters. Many statements of the same shape within one
+    request usually mean a query is run per row of an earlier query (N+1 queries).
+
+    Args:
+        label (str): What the statements were executed for, e.g. 'GET /'.
+        slow_seconds (float): Statements taking at least this long are kept as slow ones.
+
+    Attributes:
+        shapes (OrderedDict): Statement shape mapped to number of statements and seconds spent.
+        count (int): Number of statements.
+        seconds (float): Seconds spent executing statements.
+        slow (list): Seconds, SQL and parameters of slow statements.
+    """
+    def __init__(self, label, slow_seconds=None):
+        self.label = label
+        self.slow_seconds = slow_seconds
+        self.started = datetime.datetime.now()
+        self.shapes = OrderedDict()
+        self.count = 0
+        self.seconds = 0.0
+        self.slow = []
+
+    def record(self, sql, params, seconds):
+        shape = _PARAMETER_LIST.sub('(?...)', sql)
+        stats = self.shapes.setdefault(shape, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        self.count += 1
+        self.seconds += seconds
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            self.slow.append((seconds, sql, params))
+
+    def top(self, limit=10):
+        """Return the shapes statements spent most time on as tuples of shape, count and seconds."""
+        items = sorted(self.shapes.items(), key=lambda x: x[1][1], reverse=True)
+        return [(shape, count, seconds) for shape, (count, seconds) in items[:limit]]
+
+    def repeated(self, threshold):
+        """Return the shapes of statements executed at least threshold times, most frequent first."""
+        items = [(shape, count, seconds) for shape, (count, seconds) in self.shapes.items() if count >= threshold]
+        return sorted(items, key=lambda x: x[1], reverse=True)
+
+    def log_findings(self, logger, threshold):
+        """Log slow statements and likely N+1 queries."""
+        for seconds, sql, params in self.slow:
+            logger.warn('Slow query (%.3f s) for %s: %s %s', seconds, self.label, sql, params)
+        for shape, count, seconds in self.repeated(threshold):
+            logger.warn('Query run %s times (%.3f s) for %s: %s', count, seconds, self.label, shape)
+
+
+class DivvyDatabase(peewee.SqliteDatabase):
+    """SqliteDatabase whose connections can be redirected to a shadow DB file, one thread at a time.
+
+    peewee keeps one connection per thread, so redirecting the connection of the current thread leaves all other
+    threads on the live DB. Likewise, SQL statements are only timed for threads which are recording them.
+    """
+    def __init__(self, *args, **kwargs):
+        self._shadow = threading.local()
+        self._query_log = threading.local()
+        # Most recent QueryLog objects, newest last
+        self.query_logs = deque(maxlen=50)
+        super(DivvyDatabase, self).__init__(*args, **kwargs)
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        log = getattr(self._query_log, 'current', None)
+        if log is None:
+            return super(DivvyDatabase, self).execute_sql(sql, params, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super(DivvyDatabase, self).execute_sql(sql, params, *args, **kwargs)
+        finally:
+            log.record(sql, params, time.perf_counter() - start)
+
+    def start_query_log(self, label, slow_seconds=None):
+        """Start recording the SQL statements the current thread executes in a QueryLog.
+
+        If the thread is recording already, e.g. for a request running a scan, statements go to the existing log.
+
+        Args:
+            label (str): What the statements are executed for.
+            slow_seconds (float): Statements taking at least this long are kept as slow ones.
+
+        Returns:
+            QueryLog: The new log, or None if the thread is recording already.
+        """
+        if getattr(self._query_log, 'current', None) is not None:
+            return None
+        self._query_log.current = QueryLog(label, slow_seconds)
+        return self._query_log.current
+
+    def stop_query_log(self, log):
+        """Stop recording the SQL statements of the current thread and keep the log in query_logs."""
+        self._query_log.current = None
+        self.query_logs.append(log)
+
+    @property
+    def shadowed(self):
+        """Whether the current thread works on a shadow DB file."""
+        return getattr(self._shadow, 'path', None) is not None
+
+    def _connect(self):
+        path = getattr(self._shadow, 'path', None)
+        if path is None:
+            return super(DivvyDatabase, self)._connect()
+        conn = sqlite3.connect(path, timeout=self._timeout, isolation_level=None, **self.connect_params)
+        try:
+            self._add_conn_hooks(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @contextmanager
+    def shadow(self, path):
+        """Use the DB file at path instead of the live one in the current thread.
+
+        Args:
+            path (str): Path of the shadow DB file. It is created if it does not exist.
+        """
+        self.close()
+        self._shadow.path = path
+        try:
+            self.connect()
+            yield self
+        finally:
+            self.close()
+            self._shadow.path = None
+
+    def copy_tables(self, models, source, clear=True):
+        """Copy the rows of tables from another DB file into the DB in one transaction.
+
+        Args:
+            models (list): Model classes whose tables to copy, parents before children.
+            source (str): Path of the DB file to copy from.
+            clear (bool): Whether to delete the rows in the DB first.
+        """
+        self.execute_sql('ATTACH DATABASE ? AS "source"', (source,))
+        try:
+            with self.atomic('IMMEDIATE'):
+                if clear:
+                    for model in reversed(models):
+                        model.delete().execute()
+                for model in models:
+                    columns = ', '.join('"{}"'.format(f.column_name) for f in model._meta.sorted_fields)
+                    self.execute_sql('INSERT INTO "main"."{0}" ({1}) SELECT {1} FROM "source"."{0}"'
+                                     .format(model._meta.table_name, columns))
+        finally:
+            self.execute_sql('DETACH DATABASE "source"')
@@ -1,65 +1,1173 @@
+import atexit
 import datetime
+import fnmatch
 import hashlib
 import pathlib
 import os
 import re
-from collections import deque
+import socket
+import sys
+import threading
+import uuid
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from flask import flash
-from divvy import app, db
-from divvy.models import Curator, File, Folder, Reference, read_old_pmids
-
+from divvy import app, db, metrics
+from divvy.logs import LogSampler
+from divvy.profiling import PROFILER
+import peewee
+from divvy.models import (Curator, File, Folder, ParseCache, Pmid, Reference, ScanJournal, acquire_lease,
+                          claim_scan_task, collect_scan_tasks, enqueue_folder_scans, finish_scan_task,
+                          get_scan_state, new_generation, read_old_pmids, rebuild_done, rebuild_requested,
+                          record_scan, refresh_pending, release_lease, renew_scan_task, request_refresh,
+                          scan_tasks_open, scan_tasks_waiting)
+
+# The previous and the latest survey, each mapping binary checksums to FileRecord objects
 MONITOR_QUEUE = deque([{}], maxlen=2)
 
+ParsedFile = namedtuple('ParsedFile', ['entry_count', 'curator_initials', 'pmids'])
+
+# File path -> {entry digest: PubMed IDs} for recently parsed files, least recently parsed first
+ENTRY_INDEX = OrderedDict()
+
+_ENTRY_END = re.compile(r'^//[^\n]*\n?', re.MULTILINE)
+
+# Messages logged per file or reference, summarized at the end of each scan
+SAMPLED_LOG = LogSampler(app.logger, app.config['LOG_SAMPLE_LIMIT'])
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls of a function into a single run in a background thread.
+
+    The first caller starts a run. Callers arriving while it is running do not start another run but wait for the
+    running one to finish. Every caller, including the one which started the run, waits up to a timeout, so a
+    request never waits longer than it is willing to. Errors are logged rather than raised to the callers;
+    failed tells whether the latest run raised one.
+    """
+    def __init__(self, func, name):
+        self.func = func
+        self.name = name
+        self.failed = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._done.set()
+
+    @property
+    def running(self):
+        return not self._done.is_set()
+
+    def __call__(self, timeout=None, join=True):
+        """Start a run unless one is in progress and wait for it to finish.
+
+        Args:
+            timeout (float): Seconds to wait for the run. None waits indefinitely, 0 does not wait.
+            join (bool): Whether to wait for a run already in progress or to return at once.
+
+        Returns:
+            bool: True if the run finished during the call, False if it is still in progress or, unless join is
+                set, if a run was in progress already.
+        """
+        with self._lock:
+            done = self._done
+            started = done.is_set()
+            if started:
+                self._done = done = threading.Event()
+                threading.Thread(target=self._run, args=(done,), name=self.name, daemon=True).start()
+        if not (started or join):
+            return False
+        return done.wait(timeout)
+
+    def _run(self, done):
+        try:
+            self.func()
+            self.failed = False
+        except Exception:
+            app.logger.exception('%s failed.', self.name)
+            self.failed = True
+        finally:
+            done.set()
+
+
+def scan_now(timeout=None, join=True):
+    """Scan folders in a background thread unless a scan is already running, and wait for the scan.
+
+    Args:
+        timeout (float): Seconds to wait for the scan.
+        join (bool): Whether to wait for a scan already in progress or to return at once.
+
+    Returns:
+        bool: False if the scan is still in progress once the timeout has passed, or if one was in progress
+            already and join is not set.
+    """
+    return _SCAN(timeout, join)
+
+
+def last_scan_failed():
+    """Whether the latest scan started by scan_now raised an error, which has been logged."""
+    return _SCAN.failed
+
+
+class AdaptiveSchedule(object):
+    """Decide when the next scheduled scan is due.
+
+    The scheduler ticks every few seconds (see JOBS in config.py) but a scan only runs once it is due. After each scan the interval
+    drops to SCAN_INTERVAL_MIN if files changed and otherwise grows by SCAN_BACKOFF up to SCAN_INTERVAL_MAX.
+    The interval never falls below SCAN_DURATION_FACTOR times the duration of the last scan so that slow storage
+    is not scanned back to back.
+    """
+    def __init__(self):
+        self.interval = None
+        self.next_due = 0.0
+        self.last_duration = None
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        return now >= self.next_due
+
+    def record(self, duration, changes, now=None):
+        """Update the interval given the outcome of a scan.
+
+        Args:
+            duration (float): Seconds the scan took.
+            changes (int): Number of files added or deleted by the scan.
+        """
+        now = time.monotonic() if now is None else now
+        minimum = app.config['SCAN_INTERVAL_MIN']
+        maximum = app.config['SCAN_INTERVAL_MAX']
+        if changes or self.interval is None:
+            interval = minimum
+        else:
+            interval = min(self.interval * app.config['SCAN_BACKOFF'], maximum)
+        self.interval = max(interval, duration * app.config['SCAN_DURATION_FACTOR'])
+        self.last_duration = duration
+        self.next_due = now + self.interval
+        app.logger.debug('Scan took %.2fs with %s changes. Next scan in %.0fs.', duration, changes, self.interval)
+
+
+SCHEDULE = AdaptiveSchedule()
+
+
+class LeaderElection(object):
+    """Make sure only one of several processes sharing the DB scans.
+
+    The process holding the 'scanner' lease is the leader. A heartbeat thread renews the lease every third of
+    LEADER_LEASE_SECONDS. If the leader dies, its lease expires and another process takes over. Election is
+    skipped if LEADER_ELECTION is off.
+
+    A process stops considering itself leader once its lease has expired without being renewed, e.g. because the
+    DB could not be reached, as another process may have taken over by then.
+    """
+    name = 'scanner'
+
+    def __init__(self):
+        self.holder = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.leader = False
+        self.took_over = False
+        # Monotonic time at which the lease runs out unless renewed
+        self._expires = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def is_leader(self):
+        if not app.config['LEADER_ELECTION']:
+            return True
+        with self._lock:
+            if self._thread is None:
+                self._renew()
+                self._thread = threading.Thread(target=self._heartbeat, name='divvy-leader', daemon=True)
+                self._thread.start()
+                atexit.register(self.release)
+        return self._leading()
+
+    def release(self):
+        if self.leader:
+            release_lease(self.name, self.holder)
+            self.leader = False
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(app.config['LEADER_LEASE_SECONDS'] / 3)
+            try:
+                self._renew()
+            except Exception as e:
+                app.logger.error('Could not renew scanner lease: %s', e)
+                if self.leader and not self._leading():
+                    app.logger.warn('Scanner lease expired: %s', self.holder)
+                    self.leader = False
+
+    def _leading(self):
+        return self.leader and time.monotonic() < self._expires
+
+    def _renew(self):
+        # Counted from before the DB is asked, so the lease never outlasts the one in the DB.
+        expires = time.monotonic() + app.config['LEADER_LEASE_SECONDS']
+        leader = acquire_lease(self.name, self.holder, app.config['LEADER_LEASE_SECONDS'])
+        if leader and not self._leading():
+            app.logger.info('Became scanner leader: %s', self.holder)
+            self.took_over = True
+        elif self._leading() and not leader:
+            app.logger.warn('Lost scanner lease: %s', self.holder)
+        self.leader = leader
+        self._expires = expires
+
+
+LEADER = LeaderElection()
+
+
+def _reset_surveys():
+    """Forget earlier surveys so that the next scan starts from what is in the DB."""
+    MONITOR_QUEUE.clear()
+    MONITOR_QUEUE.append({})
+    SURVEY.listings.clear()
+
+
+class ScanRound(object):
+    """Keep track of a round of scan tasks enqueued by the leader when SCAN_MODE is 'queue'.
+
+    Once all tasks of a round are finished, their outcome is fed to the adaptive schedule and published to
+    other processes like that of a scan in 'single' mode.
+    """
+    def __init__(self):
+        self.started = None
+        # When the round was enqueued, None for a round adopted from a previous leader
+        self.enqueued = None
+
+    def tick(self):
+        if self.started is None and scan_tasks_open():
+            # Adopt a round enqueued by a previous leader.
+            self.started = time.monotonic()
+        if self.started is not None:
+            if scan_tasks_open():
+                return
+            changes, _, failed = collect_scan_tasks()
+            if failed:
+                app.logger.error('%s folder scans failed.', failed)
+            SCHEDULE.record(time.monotonic() - self.started, changes)
+            record_scan(changes, self.enqueued)
+            self.started = None
+            self.enqueued = None
+        if SCHEDULE.due() or refresh_pending():
+            enqueued = datetime.datetime.now()
+            count = enqueue_folder_scans()
+            app.logger.info('Enqueued %s folder scans.', count)
+            if count:
+                self.started = time.monotonic()
+                self.enqueued = enqueued
+            else:
+                record_scan(0, enqueued)
+
+
+ROUND = ScanRound()
+
+
+class TaskLease(object):
+    """Renew the claim on a scan task every third of TASK_LEASE_SECONDS while it is being processed."""
+    def __init__(self, task_id, owner):
+        self.task_id = task_id
+        self.owner = owner
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name='divvy-task', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _heartbeat(self):
+        while not self._stop.wait(app.config['TASK_LEASE_SECONDS'] / 3):
+            try:
+                if not renew_scan_task(self.task_id, self.owner, app.config['TASK_LEASE_SECONDS']):
+                    app.logger.warn('Lost claim on scan task %s.', self.task_id)
+                    return
+            except peewee.OperationalError as e:
+                app.logger.error('Could not renew claim on scan task %s: %s', self.task_id, e)
+
+
+def scheduled_scan():
+    """Entry point for the scheduler and the scanner worker.
+
+    Scans if a scan is due or a refresh has been requested by another process. Skips the tick otherwise, if a
+    scan is already running or if another process is the scanner leader.
+
+    In queue mode (SCAN_MODE = 'queue'), the leader enqueues a scan task per folder instead, and every process
+    calling this processes tasks while there are any to claim.
+    """
+    if app.config['SCAN_MODE'] == 'queue':
+        if LEADER.is_leader():
+            ROUND.tick()
+        if (scan_tasks_waiting() or _rebuild_due()) and not scan_now(join=False):
+            app.logger.debug('Already processing scan tasks.')
+        return
+    if not LEADER.is_leader():
+        return
+    refresh = refresh_pending()
+    if not (SCHEDULE.due() or refresh or _rebuild_due()):
+        return
+    if refresh:
+        SURVEY.request_full()
+    if not scan_now(join=False):
+        app.logger.info('Scan already in progress. Skipped scheduled scan.')
+
+
+def await_worker_scan(timeout):
+    """Ask the process which scans for a scan and wait for it to finish.
+
+    Used by web processes which do not scan themselves, either because a scanner worker does (SCAN_IN_WEB =
+    False) or because another process is the scanner leader.
+
+    Args:
+        timeout (float): Seconds to wait for the scan.
+
+    Returns:
+        bool: False if the scan has not finished once the timeout has passed.
+    """
+    requested = request_refresh()
+    deadline = time.monotonic() + timeout
+    while True:
+        # Scans which started before the request may have missed what is to be refreshed.
+        started = get_scan_state().last_scan_started
+        if started is not None and started >= requested:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.5)
+
+
+def _rebuild_due():
+    """Whether this process is to rebuild file and reference data (see rebuild_scan_data)."""
+    return app.config['SHADOW_REBUILD'] and LEADER.is_leader() and rebuild_requested() is not None
+
+
+def _timed_scan():
+    """Scan folders, feed the outcome to the adaptive schedule and publish it to other processes."""
+    started = datetime.datetime.now()
+    if _rebuild_due():
+        requested = rebuild_requested()
+        start = time.monotonic()
+        changes = PROFILER.call('scan', rebuild_scan_data)
+        rebuild_done(requested)
+        SCHEDULE.record(time.monotonic() - start, changes)
+        record_scan(changes, started)
+        return
+    if app.config['SCAN_MODE'] == 'queue':
+        PROFILER.call('scan', _process_scan_tasks)
+        return
+    if LEADER.took_over:
+        # Another process may have scanned since this one last did.
+        LEADER.took_over = False
+        _reset_surveys()
+    start = time.monotonic()
+    changes = PROFILER.call('scan', scan_folders)
+    SCHEDULE.record(time.monotonic() - start, changes)
+    record_scan(changes, started)
+
+
+def _recorded_scan():
+    """Run a scan, recording its SQL statements if SQL_INSTRUMENTATION is set."""
+    if not app.config['SQL_INSTRUMENTATION']:
+        return _timed_scan()
+    queries = db.start_query_log('scan', app.config['SQL_SLOW_QUERY_SECONDS'])
+    try:
+        _timed_scan()
+    finally:
+        if queries is not None:
+            db.stop_query_log(queries)
+            queries.log_findings(app.logger, app.config['SQL_REPEATED_QUERY_THRESHOLD'])
+
+
+def _threaded_scan():
+    """Run a scan in the thread started for it by scan_now and close the thread's DB connection afterwards."""
+    try:
+        _recorded_scan()
+    finally:
+        db.close()
+
+
+def rebuild_scan_data():
+    """Rebuild file and reference data from scratch without readers noticing until it is done.
 
-def scan_folders():
+    Curators, folders and cached parse results are copied into a shadow DB file next to the live one. All folders
+    are scanned into the shadow DB, which is then copied back into the live DB in a single transaction. Readers
+    therefore see either the old or the new data, never a mix, and in WAL mode never wait for the rebuild.
+
+    Returns:
+        int: Number of files added.
+    """
+    live = app.config['DATABASE_URI']
+    shadow = live + '.shadow'
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        try:
+            os.remove(shadow + suffix)
+        except FileNotFoundError:
+            pass
+    app.logger.info('Rebuilding file and reference data in %s.', shadow)
+    _reset_surveys()
+    try:
+        with db.shadow(shadow):
+            db.create_tables([Curator, Folder] + _SHADOW_TABLES)
+            db.copy_tables([Curator, Folder, ParseCache], live)
+            # A partial data set must not be swapped in, so the work budget does not apply.
+            changes = scan_folders(budgeted=False)
+        db.copy_tables(_SHADOW_TABLES, shadow)
+    except Exception:
+        _reset_surveys()
+        raise
+    finally:
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            try:
+                os.remove(shadow + suffix)
+            except FileNotFoundError:
+                pass
+    app.logger.info('Swapped in rebuilt data of %s files.', changes)
+    return changes
+
+
+# Tables swapped in after a rebuild, parents before children
+_SHADOW_TABLES = [ParseCache, Pmid, File, Reference, ScanJournal]
+
+
+def _process_scan_tasks():
+    """Claim and process scan tasks until there are none left.
+
+    Returns:
+        int: Number of files added, modified or deleted.
+    """
+    owner = LEADER.holder
+    total = 0
+    while True:
+        task = claim_scan_task(owner, app.config['TASK_LEASE_SECONDS'])
+        if task is None:
+            return total
+        app.logger.info('Claimed scan task %s for folder %s.', task.id, task.folder.path)
+        start = time.monotonic()
+        try:
+            with TaskLease(task.id, owner):
+                changes = scan_folder(task.folder)
+        except Exception:
+            app.logger.exception('Scan of folder %s failed.', task.folder.path)
+            metrics.SCANS.labels('failure').inc()
+            finish_scan_task(task.id, owner, failed=True)
+            continue
+        if not finish_scan_task(task.id, owner, changes, time.monotonic() - start):
+            app.logger.warn('Result of scan task %s was not accepted.', task.id)
+        total += changes
+
+
+def scan_folder(folder_instance):
+    """Scan a single folder, comparing the files in it with the folder's File model instances in the DB.
+
+    This is what a scan task does. As any worker may scan any folder, the only state kept between scans are
+    listings and checksums to speed up surveys; what is new, modified or gone is determined from the DB. A
+    file counts as modified if a file of the same name is gone.
+
+    New files which do not fit in the work budget are simply found again by the next scan of the folder.
+
+    Args:
+        folder_instance (Folder): Folder model instance.
+
+    Returns:
+        int: Number of files added, modified or deleted.
+    """
+    stats = ScanStats.start()
+    _load_swissprot_pubmed_ids()
+    folder = folder_instance.path
+    if not os.path.isdir(folder):
+        app.logger.error('There was an error accessing %s', folder)
+        return 0
+    with stats.phase('survey'):
+        survey, previous = _FOLDER_SURVEYS.get(folder) or (FolderSurvey(), ())
+        survey.start(previous)
+        current = {record.checksum: record for record in survey.files(folder)}
+        survey.finish()
+    stats.count('files surveyed', len(current))
+    _FOLDER_SURVEYS[folder] = (survey, list(current.values()))
+    stored = {bytes.fromhex(checksum): filename for checksum, filename in
+              File.select(File.checksum, File.filename).where(File.folder == folder_instance).tuples()}
+    gone = {}
+    for checksum in stored.keys() - current.keys():
+        gone.setdefault(stored[checksum], []).append(checksum)
+    modified = {}
+    for checksum in current.keys() - stored.keys():
+        candidates = gone.get(current[checksum].path.name)
+        if candidates:
+            modified[checksum] = candidates.pop()
+    changes = 0
+    with stats.phase('delete'), db.atomic():
+        for checksum in stored.keys() - current.keys() - set(modified.values()):
+            File.get(File.checksum == checksum.hex()).delete_instance(recursive=True)
+            app.logger.info('Deleted file from db: %s', stored[checksum])
+            changes += 1
+        if changes:
+            _new_generation()
+    stats.count('files deleted', changes)
+    pending = _prioritize(current[checksum] for checksum in current.keys() - stored.keys())
+    added, deferred = _process_files(pending, modified)
+    changes += added
+    if deferred:
+        app.logger.info('Work budget spent. Deferred %s files in %s.', len(deferred), folder)
+    if changes:
+        _delete_orphaned_pmids()
+    _evict_parse_cache()
+    stats.finish()
+    return changes
+
+
+# Folder path -> (FolderSurvey, FileRecord objects of its latest survey), for scan_folder
+_FOLDER_SURVEYS = {}
+
+
+def scan_folders(budgeted=True):
     """Extract file data for QA.
 
     This is the workhorse function. It re-compiles information on files and references contained in them.
-    Previous records of files and references are wiped at the start.
+    Files which are gone since the last scan are deleted from the DB, new ones are added. Files which changed in
+    place are updated, re-parsing only the entries which changed (see _parse_entries).
+
+    New files are processed in priority order (see _prioritize) until the work budget set by SCAN_TIME_BUDGET
+    and SCAN_BYTE_BUDGET is spent, unless budgeted is False; the remaining files are left for the next scan.
+    Processed files are committed every SCAN_CHECKPOINT_FILES files, each file's File and Reference rows in
+    the same transaction. Planned work is recorded in the ScanJournal table so that files a failed or
+    interrupted scan did not commit are picked up first by the next one.
+
+    Args:
+        budgeted (bool): Whether to leave files for the next scan once the work budget is spent.
+
+    Returns:
+        int: Number of files added or deleted.
 
     """
-    _load_swissprot_pubmed_ids()
-    reference_models = []
-    _survey_files_in_folders()
-    _delete_obsolete_files()
-    for wrapped_path in files2add():
-        file_model_dict = _extract_file_data(wrapped_path)
-        app.logger.debug('Prepared dict for file: {}'.format(str(wrapped_path.path)))
-        app.logger.debug((file_model_dict))
-        with db.atomic():
-            File.insert(**file_model_dict).execute()
-            app.logger.debug('Inserted File into db: {}'.format(str(wrapped_path.path)))
-        reference_models_temp = _extract_pmids(wrapped_path)
-        reference_models.extend(reference_models_temp)
-        app.logger.debug('Prepared pmid dict for file: {}'.format(str(wrapped_path.path)))
-    if reference_models:
-        app.logger.info('Collected {} references to write to DB.'.format(str(len(reference_models))))
-        with db.atomic():
-            Reference.insert_many(reference_models).execute()
+    stats = ScanStats.start()
+    with stats.phase('pmid_load'):
+        _load_swissprot_pubmed_ids()
+    with stats.phase('setup'):
+        if len(MONITOR_QUEUE) < 2:
+            _resync_monitor_queue()
+        resumed = set(bytes.fromhex(row.checksum) for row in ScanJournal.select(ScanJournal.checksum))
+    if resumed:
+        app.logger.info('Resuming interrupted scan with %s files pending.', len(resumed))
+    changes = 0
+    deferred = []
+    try:
+        with stats.phase('survey'):
+            _survey_files_in_folders()
+        stats.count('files surveyed', len(MONITOR_QUEUE[-1]))
+        with stats.phase('diff'):
+            modified = _modified_files()
+        with stats.phase('delete'):
+            deleted = _delete_obsolete_files(keep=set(modified.values()))
+        stats.count('files deleted', deleted)
+        changes += deleted
+        with stats.phase('diff'):
+            pending = _prioritize(files2add(), first=resumed)
+        with stats.phase('journal'):
+            _journal_pending(pending)
+        added, deferred = _process_files(pending, modified, budgeted)
+        changes += added
+    except Exception:
+        app.logger.exception('Scan failed. Uncommitted files will be retried by the next scan.')
+        metrics.SCANS.labels('failure').inc()
+        _resync_monitor_queue()
+        raise
+    if deferred:
+        _defer_files(deferred, modified)
+        app.logger.info('Work budget spent. Deferred %s files to the next scan.', len(deferred))
+    with stats.phase('cleanup'):
+        ScanJournal.delete().execute()
+        if changes:
+            _delete_orphaned_pmids()
+        _evict_parse_cache()
+    stats.finish()
+    return changes
+
+
+class ScanStats(object):
+    """Time the phases of a scan and count what it processed.
+
+    Each scan starts a new instance; the latest one is kept in ScanStats.latest for reporting, see divvy.scan.
+    Finished scans are also added to the metrics exposed on /metrics.
+
+    Attributes:
+        phases (OrderedDict): Phase names mapped to seconds spent in them.
+        counts (OrderedDict): What was counted, e.g. 'files parsed', mapped to counts.
+        seconds (float): Duration of the whole scan once finished.
+    """
+    latest = None
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.counts = OrderedDict()
+        self.seconds = None
+        self._started = time.monotonic()
+
+    @classmethod
+    def start(cls):
+        SAMPLED_LOG.flush()
+        cls.latest = cls()
+        return cls.latest
+
+    @classmethod
+    def current(cls):
+        """Return the stats of the running scan, or throw-away stats if there is none."""
+        if cls.latest is None or cls.latest.seconds is not None:
+            return cls()
+        return cls.latest
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self):
+        self.seconds = time.monotonic() - self._started
+        SAMPLED_LOG.flush()
+        metrics.SCANS.labels('success').inc()
+        metrics.SCAN_DURATION.observe(self.seconds)
+        for name, seconds in self.phases.items():
+            metrics.SCAN_PHASE_DURATION.labels(name).observe(seconds)
+        for action in ('parsed', 'modified', 'deleted', 'deferred'):
+            metrics.SCAN_FILES.labels(action).inc(self.counts.get('files ' + action, 0))
+        metrics.SCAN_BYTES.inc(self.counts.get('bytes parsed', 0))
+        metrics.SCAN_REFERENCES.inc(self.counts.get('references written', 0))
+
+
+def _scan_lag():
+    """Seconds since the last scan finished, by whichever process, or None if there has been none."""
+    last_scan = get_scan_state().last_scan
+    if last_scan is None:
+        return None
+    return (datetime.datetime.now() - last_scan).total_seconds()
+
+
+SCAN_LAG = metrics.Gauge('divvy_scan_lag_seconds', 'Seconds since the last successful scan finished.',
+                         func=_scan_lag)
+SCAN_GENERATION = metrics.Gauge('divvy_scan_generation', 'Generation of the data shown on the index page.',
+                                func=lambda: get_scan_state().generation)
+
+
+def _io_executor():
+    """Return the thread pool used to read files concurrently, or None if SCAN_IO_WORKERS is below 2.
+
+    Reading files from network shares is dominated by latency. A few threads reading ahead hide it while
+    parsing and DB writes stay in the scanning thread.
+    """
+    workers = app.config['SCAN_IO_WORKERS']
+    if workers < 2:
+        return None
+    if workers not in _IO_EXECUTORS:
+        _IO_EXECUTORS[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='divvy-io')
+    return _IO_EXECUTORS[workers]
+
+
+_IO_EXECUTORS = {}
+
+
+def _read_bytes(pth):
+    with open(pth.location, 'rb') as f:
+        return f.read()
+
+
+def _prefetch(records):
+    """Read files ahead of processing them.
+
+    Files are read in a thread pool while the caller works on earlier ones. At most SCAN_PREFETCH_MAX_BYTES
+    bytes (going by file size) are read ahead but always at least one file. Files whose parse result is
+    already known are not read.
+
+    Args:
+        records (list): FileRecord objects in processing order.
+
+    Returns:
+        generator (tuple): FileRecord object and its content (bytes or None).
+    """
+    executor = _io_executor()
+    if executor is None:
+        for record in records:
+            yield record, None
+        return
+    max_bytes = app.config['SCAN_PREFETCH_MAX_BYTES']
+    in_flight = deque()
+    in_flight_bytes = 0
+    upcoming = iter(records)
+    try:
+        for record in upcoming:
+            if record.parsed is not None:
+                in_flight.append((record, None))
+            else:
+                while in_flight and in_flight_bytes + record.size > max_bytes:
+                    done, future = in_flight.popleft()
+                    if future:
+                        in_flight_bytes -= done.size
+                    yield done, _prefetched_content(done, future)
+                in_flight.append((record, executor.submit(_read_bytes, record)))
+                in_flight_bytes += record.size
+        while in_flight:
+            done, future = in_flight.popleft()
+            yield done, _prefetched_content(done, future)
+    finally:
+        for _, future in in_flight:
+            if future:
+                future.cancel()
+
+
+def _prefetched_content(pth, future):
+    """Return the content read for a file or None if there is none, leaving errors to the scanning thread."""
+    if future is None:
+        return None
+    try:
+        return future.result()
+    except OSError as e:
+        app.logger.debug('Prefetching %s failed: %s', pth.location, e)
+        return None
+
+
+def _process_files(pending, modified, budgeted=True):
+    """Parse new and modified files and commit them to the DB until the work budget is spent.
+
+    Args:
+        pending (list): FileRecord objects in processing order.
+        modified (dict): Checksums of modified files mapped to checksums of their previous versions.
+        budgeted (bool): Whether to stop once the work budget is spent or to process all files.
+
+    Returns:
+        tuple: Number of committed files, list of FileRecord objects deferred to the next scan.
+    """
+    _load_cached_parses(pending)
+    if budgeted:
+        budget = ScanBudget(app.config['SCAN_TIME_BUDGET'], app.config['SCAN_BYTE_BUDGET'])
     else:
-        app.logger.warn('No references collected to add to DB.')
+        budget = ScanBudget()
+    changes = 0
+    deferred = []
+    batch = []
+    records = []
+    stats = ScanStats.current()
+    files = _prefetch(pending)
+    for idx in range(len(pending)):
+        if budget.spent():
+            deferred = pending[idx:]
+            break
+        with stats.phase('read'):
+            record, content = next(files)
+        with stats.phase('parse'):
+            _parse_file(record, content)
+            file_model_dict = _extract_file_data(record)
+            SAMPLED_LOG.debug('Prepared dict for file: %s', record.path)
+            SAMPLED_LOG.debug('File data: %s', file_model_dict)
+            new_pmids, known_pmids = _extract_pmids(record)
+            SAMPLED_LOG.debug('Prepared pmid dict for file: %s', record.path)
+        batch.append((file_model_dict, new_pmids, known_pmids, modified.get(record.checksum)))
+        records.append(record)
+        budget.charge(record.size)
+        stats.count('files parsed')
+        stats.count('files modified', record.checksum in modified)
+        stats.count('bytes parsed', record.size)
+        if len(batch) >= app.config['SCAN_CHECKPOINT_FILES']:
+            with stats.phase('commit'):
+                changes += _commit_batch(batch)
+            _forget_parses(records)
+            batch = []
+            records = []
+    with stats.phase('commit'):
+        changes += _commit_batch(batch)
+    _forget_parses(records)
+    _forget_parses(deferred)
+    stats.count('files deferred', len(deferred))
+    return changes, deferred
+
+
+def _forget_parses(records):
+    """Drop the parse results of files once committed, as their records are kept in MONITOR_QUEUE."""
+    for record in records:
+        record.parsed = None
+
+
+class ScanBudget(object):
+    """Track the work done in a scan against a time and a byte budget.
+
+    Either budget may be None, i.e. unlimited. At least one file is processed per scan so that scans always make
+    progress.
+    """
+    def __init__(self, seconds=None, nbytes=None):
+        self.seconds = seconds
+        self.nbytes = nbytes
+        self.start = time.monotonic()
+        self.bytes_read = 0
+        self.files = 0
+
+    def charge(self, nbytes):
+        self.bytes_read += nbytes
+        self.files += 1
+
+    def spent(self):
+        if not self.files:
+            return False
+        if self.seconds is not None and time.monotonic() - self.start >= self.seconds:
+            return True
+        if self.nbytes is not None and self.bytes_read >= self.nbytes:
+            return True
+        return False
+
+
+def _commit_batch(batch):
+    """Write File, Pmid and Reference rows for a batch of processed files in one transaction.
+
+    PubMed IDs already in the Pmid table are left as they are. Modified files update the File row of their
+    previous version and only the references which differ. The files are removed from the scan journal in the
+    same transaction.
+
+    Args:
+        batch (list): Tuples of File model dict, new PMIDs, known PMIDs and the checksum (bytes) of the file's
+            previous version if it was modified.
+
+    Returns:
+        int: Number of committed files.
+    """
+    if not batch:
+        return 0
+    pmid_models = {}
+    reference_models = []
+    with db.atomic():
+        for file_model_dict, new_pmids, known_pmids, old_checksum in batch:
+            file_id = None
+            if old_checksum is not None:
+                file_id = File.select(File.id).where(File.checksum == old_checksum.hex()).scalar()
+            if file_id is None:
+                file_id = File.insert(**file_model_dict).execute()
+                SAMPLED_LOG.debug('Inserted File into db: %s', file_model_dict['filename'])
+                stored = set()
+            else:
+                File.update(**file_model_dict).where(File.id == file_id).execute()
+                SAMPLED_LOG.debug('Updated File in db: %s', file_model_dict['filename'])
+                stored = _update_references(file_id, new_pmids | known_pmids)
+            pmids, references = _compile_reference_models(new_pmids, known_pmids, file_id)
+            references = [x for x in references if x['pmid'] not in stored]
+            pmid_models.update((x['id'], x) for x in pmids)
+            reference_models.extend(references)
+        stats = ScanStats.current()
+        stats.count('references written', len(reference_models))
+        stats.count('PubMed IDs collected', len(pmid_models))
+        if reference_models:
+            app.logger.info('Collected %s references to write to DB.', len(reference_models))
+            for chunk in peewee.chunked(list(pmid_models.values()), 400):
+                Pmid.insert_many(chunk).on_conflict_ignore().execute()
+            for chunk in peewee.chunked(reference_models, 400):
+                Reference.insert_many(chunk).execute()
+        else:
+            app.logger.warn('No references collected to add to DB.')
+        checksums = [item[0]['checksum'] for item in batch]
+        ScanJournal.delete().where(ScanJournal.checksum.in_(checksums)).execute()
+        _new_generation()
+    return len(batch)
+
+
+def _new_generation():
+    """Start a new data generation for changes a scan commits before it has finished (see ScanState).
+
+    Rebuilds write to a shadow DB, whose data only become visible when swapped in by record_scan.
+    """
+    if not db.shadowed:
+        new_generation()
+
+
+def _update_references(file_id, pmids):
+    """Delete references of a file to PubMed IDs it no longer cites.
+
+    Args:
+        file_id (int): primary key of the File
+        pmids (set): PubMed IDs (str) the file cites now
+
+    Returns:
+        set: PubMed IDs (int) the file already refers to and still cites.
+    """
+    wanted = set(int(pmid) for pmid in pmids)
+    stored = set(row.pmid_id for row in Reference.select(Reference.pmid).where(Reference.sourcefile == file_id))
+    obsolete = stored - wanted
+    if obsolete:
+        (Reference
+         .delete()
+         .where(Reference.sourcefile == file_id, Reference.pmid.in_(list(obsolete)))
+         .execute())
+    return stored & wanted
+
+
+def _journal_pending(records):
+    """Record the files a scan is about to process, replacing any earlier journal."""
+    rows = [{'checksum': x.checksum.hex(), 'path': x.location} for x in records]
+    with db.atomic():
+        ScanJournal.delete().execute()
+        for idx in range(0, len(rows), 100):
+            ScanJournal.insert_many(rows[idx:idx + 100]).execute()
+
+
+def _resync_monitor_queue():
+    """Make the DB the reference point for the next survey.
+
+    The checksums of all committed files become the latest snapshot. Files not committed, be it because a scan
+    failed or because the process was restarted, are thus found again by the next scan whereas committed ones
+    are not processed twice.
+    """
+    MONITOR_QUEUE.append({bytes.fromhex(row.checksum): None for row in File.select(File.checksum)})
+
+
+def _prioritize(records, first=()):
+    """Order new files for processing.
+
+    Files whose checksums are in first, e.g. left over from an interrupted scan, come first. Otherwise, each
+    folder's files are sorted according to its priority in SCAN_FOLDER_OPTIONS, falling back to
+    SCAN_PRIORITY: 'newest' or 'oldest' modification time first, or 'smallest' file first.
+    Folders then take turns so that a bulk drop into one folder does not hold up the others.
+
+    Args:
+        records (iterable): FileRecord objects.
+        first (set): Checksums of files to process before all others.
 
+    Returns:
+        list: FileRecord objects in processing order.
+    """
+    sort_keys = {'newest': lambda x: -x.mtime,
+                 'oldest': lambda x: x.mtime,
+                 'smallest': lambda x: x.size,
+                 }
+    by_folder = {}
+    ordered = []
+    for record in records:
+        if record.checksum in first:
+            ordered.append(record)
+            continue
+        by_folder.setdefault(record.folder, []).append(record)
+    queues = []
+    for folder, items in sorted(by_folder.items()):
+        priority = _folder_option(folder, 'priority', app.config['SCAN_PRIORITY'])
+        queues.append(sorted(items, key=sort_keys[priority]))
+    for rank in range(max((len(q) for q in queues), default=0)):
+        ordered.extend(q[rank] for q in queues if rank < len(q))
+    return ordered
+
+
+def _folder_option(folder, key, default=None):
+    """Look up a per-folder scan option in SCAN_FOLDER_OPTIONS."""
+    return app.config['SCAN_FOLDER_OPTIONS'].get(folder, {}).get(key, default)
+
+
+def _defer_files(records, modified):
+    """Forget files in the latest survey so that the next scan picks them up as new.
+
+    For modified files, the previous version is put back so that the next scan updates it rather than adding
+    the file a second time.
+
+    Args:
+        records (list): FileRecord objects.
+        modified (dict): Checksums of modified files mapped to checksums of their previous versions.
+    """
+    current = MONITOR_QUEUE[-1]
+    for record in records:
+        current.pop(record.checksum, None)
+        if record.checksum in modified:
+            old_checksum = modified[record.checksum]
+            current[old_checksum] = MONITOR_QUEUE[0][old_checksum]
+
+
+_SCAN = SingleFlight(_threaded_scan, 'divvy-scan')
+
+
+class FileRecord(object):
+    """Compact record of a surveyed file.
 
-class WrappedPath(object):
-    """Wraps a Pathlib object.
+    Surveys of tens of thousands of files are kept between scans, hence __slots__, interned path strings and
+    binary digests instead of pathlib objects and hex strings.
 
-    Allows to add more attributes as PurePath-derived objects
-    use slots.
+    Attributes:
+        location (str): Fully qualified file path.
+        folder (str): Path of the Folder the file was found in.
+        size (int): File size in bytes.
+        mtime (float): Modification time.
+        content_hash (bytes): md5 digest of the file content.
+        checksum (bytes): md5 digest of file content and name.
+        parsed (ParsedFile): Parse result while the file is processed in a scan, None otherwise.
     """
-    def __init__(self, path):
-        self.path = path
-        self.checksum = self._compute_checksum_for_file()
+    __slots__ = ('location', 'folder', 'size', 'mtime', 'content_hash', 'checksum', 'parsed')
 
-    def _compute_checksum_for_file(self):
-        """Compute md5 of file name and content.
+    def __init__(self, path, folder, stat=None):
+        self.location = sys.intern(str(path))
+        self.folder = sys.intern(folder)
+        stat = os.stat(self.location) if stat is None else stat
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.parsed = None
+        self.content_hash, self.checksum = self._compute_checksums_for_file()
+
+    @property
+    def path(self):
+        return pathlib.Path(self.location)
+
+    def _compute_checksums_for_file(self):
+        """Compute md5 of file content and of file name and content.
 
         Returns:
-            hexdigest of checksum (str)
+            tuple: digests of content checksum and of name and content checksum (bytes)
         """
         cs = hashlib.md5()
-        cs.update(self.path.read_bytes())
-        cs.update(bytes(self.path))
-        return cs.hexdigest()
+        with open(self.location, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                cs.update(chunk)
+        content_hash = cs.digest()
+        cs.update(os.fsencode(self.location))
+        return content_hash, cs.digest()
+
+    def unchanged(self, stat):
+        """Whether stat data of the file still match the record."""
+        return self.size == stat.st_size and self.mtime == stat.st_mtime
+
+
+class FolderSurvey(object):
+    """List the files in folders, reusing what is known from previous surveys.
+
+    Directories are listed with os.scandir. The listing of a directory whose modification time has not changed
+    since the previous survey is reused, but its files are still stat-ed since editing a file in place does not
+    change the directory's modification time. Checksums of files whose size and modification time have not changed
+    are reused. All directories are listed again once SCAN_FULL_SURVEY_SECONDS have passed since the last full
+    survey and when a full survey has been requested, e.g. by a refresh.
+
+    Per folder, SCAN_FOLDER_OPTIONS may set 'recursive' to include subdirectories as well as 'include' and
+    'exclude' lists of glob patterns matched against file names.
+    """
+    def __init__(self):
+        # Directory path -> (modification time, FileRecord objects, subdirectory paths)
+        self.listings = {}
+        self.previous = {}
+        self.full = True
+        self.full_requested = False
+        # Monotonic time of the last full survey
+        self.last_full = None
+        self.visited = set()
+
+    def start(self, previous):
+        """Prepare a new survey.
+
+        Args:
+            previous (iterable): FileRecord objects from the previous survey.
+        """
+        self.previous = {record.location: record for record in previous if record is not None}
+        now = time.monotonic()
+        self.full = (not app.config['SCAN_SKIP_UNCHANGED_DIRS'] or self.full_requested or self.last_full is None
+                     or now - self.last_full >= app.config['SCAN_FULL_SURVEY_SECONDS'])
+        self.full_requested = False
+        if self.full:
+            self.last_full = now
+        self.visited = set()
+
+    def request_full(self):
+        """Have the next survey list all directories again."""
+        self.full_requested = True
+
+    def finish(self):
+        """Forget listings of directories which were not part of the survey."""
+        for directory in set(self.listings) - self.visited:
+            del self.listings[directory]
+        self.previous = {}
+
+    def files(self, folder):
+        """List the files in a folder.
+
+        Args:
+            folder (str): Folder path.
+
+        Returns:
+            generator (FileRecord): FileRecord objects.
+        """
+        options = {'recursive': _folder_option(folder, 'recursive', False),
+                   'include': _folder_option(folder, 'include', ['*']),
+                   'exclude': _folder_option(folder, 'exclude', []),
+                   }
+        yield from self._files_in_directory(folder, folder, options)
+
+    def _files_in_directory(self, directory, folder, options):
+        self.visited.add(directory)
+        cached = self.listings.get(directory)
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+            if cached and cached[0] == mtime and not self.full:
+                _, listed, subdirectories = cached
+                records = []
+                to_hash = []
+                for record in listed:
+                    try:
+                        stat = os.stat(record.location)
+                    except FileNotFoundError:
+                        continue
+                    if record.unchanged(stat):
+                        records.append(record)
+                    else:
+                        to_hash.append((record.location, folder, stat))
+                records.extend(record for record in self._hash(to_hash) if record is not None)
+                self.listings[directory] = (mtime, records, subdirectories)
+            else:
+                records = []
+                to_hash = []
+                subdirectories = []
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            if self._wanted(entry.name, options):
+                                stat = entry.stat()
+                                record = self.previous.get(entry.path)
+                                if record is not None and record.folder == folder and record.unchanged(stat):
+                                    records.append(record)
+                                else:
+                                    to_hash.append((entry.path, folder, stat))
+                        elif options['recursive'] and entry.is_dir():
+                            subdirectories.append(entry.path)
+                records.extend(record for record in self._hash(to_hash) if record is not None)
+                self.listings[directory] = (mtime, records, subdirectories)
+        except OSError as e:
+            app.logger.error('There was an error accessing %s: %s', directory, e)
+            return
+        yield from records
+        for subdirectory in subdirectories:
+            yield from self._files_in_directory(subdirectory, folder, options)
+
+    @staticmethod
+    def _hash(to_hash):
+        """Create FileRecord objects for new or changed files, reading them concurrently if possible.
+
+        Args:
+            to_hash (list): Tuples of path, folder and stat data.
+
+        Returns:
+            iterable: FileRecord objects or None for files which could not be read.
+        """
+        executor = _io_executor()
+        if executor is None or len(to_hash) < 2:
+            return [_new_record(args) for args in to_hash]
+        return executor.map(_new_record, to_hash)
+
+    @staticmethod
+    def _wanted(name, options):
+        return (any(fnmatch.fnmatch(name, pattern) for pattern in options['include'])
+                and not any(fnmatch.fnmatch(name, pattern) for pattern in options['exclude']))
+
+
+SURVEY = FolderSurvey()
+
+
+def _new_record(args):
+    """Create a FileRecord from path, folder and stat data or return None if the file cannot be read."""
+    try:
+        return FileRecord(*args)
+    except OSError as e:
+        app.logger.error('There was an error accessing %s: %s', args[0], e)
+        return None
 
 
 def _load_swissprot_pubmed_ids():
@@ -76,52 +1184,63 @@ def _check_whether_resubmission(pth):
     """Check whether a given file is a resubmission.
 
     Args:
-        pth: WrappedPath object.
+        pth: FileRecord object.
 
     Returns:
         bool
 
     """
-    app.logger.debug('_check_whether_resubmission: {}'.format(pth.path))
+    SAMPLED_LOG.debug('_check_whether_resubmission: %s', pth.path)
     return 'resub' in str(pth.path)
 
 
-def _count_entries_in_file(pth):
+def _read_text(pth, content=None):
+    """Return the text of a file.
+
+    Args:
+        pth: FileRecord object.
+        content (bytes): File content if it has been read already.
+
+    Returns:
+        str: File content with line endings normalized to newlines, empty if the file cannot be read.
+
+    """
+    if content is None:
+        try:
+            content = _read_bytes(pth)
+        except PermissionError:
+            app.logger.error('No permission to access file: %s', pth.location)
+            return ''
+    return content.decode('latin1').replace('\r\n', '\n')
+
+
+def _count_entries_in_file(file_content):
     """Count the number of Uniprot entries in a file.
 
     We use //, the end-of-entry delimiter, as a measure. In LOG files this might underestimate numbers but that is
     accepted.
 
     Args:
-        pth: WrappedPath object.
+        file_content (str): File content.
 
     Returns:
         int: Entry count.
 
     """
-    app.logger.debug('_count_entries_in_file: {}'.format(str(pth.path)))
-    try:
-        file_content = pth.path.read_text()
-        count = len(re.findall('\n//', file_content))
-    except PermissionError:
-        count = 0
-        app.logger.error('No permission to access file: {}'.format(str(pth.path)))
-    finally:
-        return count
+    return len(re.findall('\n//', file_content))
 
 
-def _find_curator_initials(pth):
+def _find_curator_initials(file_content):
     """Initials allow us to then retrieve a Curator
 
         Args:
-            pth: WrappedPath object.
+            file_content (str): File content.
 
         Returns:
             str: Initials or None
         """
     initials = None
     regex = app.config['CUR_REGEX']
-    file_content = pth.path.read_text()
     curator_match = re.search(regex, file_content)
     if curator_match:
         initials = curator_match.group(0).split()[1]
@@ -132,24 +1251,24 @@ def _find_curator(pth):
     """Identify who authored entries contained in file.
 
     Args:
-        pth: WrappedPath object.
+        pth: FileRecord object.
 
     Returns:
         model instance: Curator model instance.
 
     """
-    curator_initial = _find_curator_initials(pth)
+    curator_initial = _parse_file(pth).curator_initials
     if curator_initial:
         try:
             curator_model_instance = Curator.select().where(Curator.initial == curator_initial).get()
-            app.logger.info('Curator found for file: {}'.format(str(pth.path)))
+            SAMPLED_LOG.info('Curator found for file: %s', pth.path)
         except:
-            app.logger.warn('No curator found for initial: {}'.format(curator_initial))
+            app.logger.warn('No curator found for initial: %s', curator_initial)
             curator_model_instance = Curator.select().where(Curator.initial == 'XYZ').get()
     else:
         # Assign this to 'Nobody'
         curator_model_instance = Curator.select().where(Curator.initial == 'XYZ').get()
-        app.logger.warn('No curator found for file: {}'.format(str(pth.path)))
+        app.logger.warn('No curator found for file: %s', pth.path)
     return curator_model_instance
 
 
@@ -157,12 +1276,12 @@ def _find_folder(pth):
     """Get Folder model instance for file.
 
     Args:
-        pth: WrappedPath object.
+        pth: FileRecord object.
 
     Returns:
         model instance: Folder
     """
-    folder_model_instance = Folder.select().where(Folder.path == str(pth.path.parent)).get()
+    folder_model_instance = Folder.select().where(Folder.path == pth.folder).get()
     return folder_model_instance
 
 
@@ -185,77 +1304,192 @@ def _is_small_scale_reference(rp_tokens):
     return 'LARGE SCALE' not in rp_line
 
 
+def _parse_file(pth, content=None):
+    """Parse the content of a file, using the parse cache if the content has been seen before.
+
+    The result is also kept on the FileRecord object for the duration of the scan.
+
+    Args:
+        pth: FileRecord object.
+        content (bytes): File content if it has been read already.
+
+    Returns:
+        ParsedFile: Entry count, curator initials and PubMed IDs of small scale references.
+
+    """
+    if pth.parsed is None:
+        _load_cached_parses([pth])
+    if pth.parsed is None:
+        text = _read_text(pth, content)
+        pth.parsed = ParsedFile(_count_entries_in_file(text), _find_curator_initials(text), _parse_entries(pth, text))
+        ParseCache.insert(content_hash=pth.content_hash.hex(),
+                          entry_count=pth.parsed.entry_count,
+                          curator_initials=pth.parsed.curator_initials,
+                          pmids=' '.join(sorted(pth.parsed.pmids))).on_conflict_ignore().execute()
+    return pth.parsed
+
+
+def _load_cached_parses(records):
+    """Fill in parse results of files from the parse cache, looking them up in bulk.
+
+    Args:
+        records (list): FileRecord objects.
+    """
+    by_hash = {}
+    for record in records:
+        if record.parsed is None:
+            by_hash.setdefault(record.content_hash.hex(), []).append(record)
+    hashes = list(by_hash)
+    for idx in range(0, len(hashes), 500):
+        chunk = hashes[idx:idx + 500]
+        for cached in ParseCache.select().where(ParseCache.content_hash.in_(chunk)):
+            parsed = ParsedFile(cached.entry_count, cached.curator_initials, set(cached.pmids.split()))
+            for record in by_hash[cached.content_hash]:
+                SAMPLED_LOG.debug('Parse cache hit for file: %s', record.location)
+                record.parsed = parsed
+        (ParseCache
+         .update(last_used=datetime.datetime.now())
+         .where(ParseCache.content_hash.in_(chunk))
+         .execute())
+
+
+def _evict_parse_cache():
+    """Delete the least recently used parse results beyond PARSE_CACHE_SIZE."""
+    stale = (ParseCache
+             .select(ParseCache.id)
+             .order_by(ParseCache.last_used.desc())
+             .offset(app.config['PARSE_CACHE_SIZE']))
+    deleted = ParseCache.delete().where(ParseCache.id.in_(stale)).execute()
+    if deleted:
+        app.logger.debug('Evicted %s results from the parse cache.', deleted)
+
+
 def _extract_pmids(pth):
     """Extract PubMed IDs from entries.
 
     Args:
-        pth: WrappedPath object.
+        pth: FileRecord object.
 
     Returns:
-        list: List of dicts describing Reference model instances.
+        tuple: Sets of PMIDs not yet in Swiss-Prot and of PMIDs already in Swiss-Prot.
 
     """
-    pmid_set_tmp = set()
-    with open(pth.path, 'r', encoding='latin1') as f:
-        rp_tmp = []
-        for line in f:
-            prefix, rest = _split2prefix_and_rest(line)
-            if prefix == 'RP':
-                rp_tmp.append(rest)
-            elif prefix == 'RC':
-                pass
-            elif prefix == 'RX':
-                if _is_small_scale_reference(rp_tmp):
-                    match = _search4pmid(rest)
-                    if match:
-                        pmid = _extract_pmid_from_match(match)
-                        pmid_set_tmp.add(pmid)
-                else:
-                    app.logger.warn('Ignored LARGE SCALE ref: {}'.format(rest))
-                    app.logger.info('RP tokens for above reference: {}'.format(rp_tmp))
-            else:
-                rp_tmp = []
-    known_pmids, new_pmids = _compare_pmid_sets(pmid_set_tmp)
+    known_pmids, new_pmids = _compare_pmid_sets(_parse_file(pth).pmids)
     _log_known_pmids(known_pmids, pth)
-    reference_model_list = _compile_reference_models(new_pmids, known_pmids, pth)
-    return reference_model_list
+    return new_pmids, known_pmids
 
 
-def _compile_reference_models(new_pmids, known_pmids, pth):
-    """Prepare a list of Reference model dicts which can be added to the DB.
+def _split_entries(file_content):
+    """Split file content into entries, each ending with a // line except maybe the last.
 
     Args:
-        new_pmids (set): gathered PMIDs which are not yet in Swiss-Prot
-        known_pmids (set): gathered PMIDs which are already in Swiss-Prot
-        th (path): path to a file
+        file_content (str): File content.
+
+    Returns:
+        generator (str): Entries.
+    """
+    start = 0
+    for match in _ENTRY_END.finditer(file_content):
+        yield file_content[start:match.end()]
+        start = match.end()
+    if start < len(file_content):
+        yield file_content[start:]
+
+
+def _parse_entries(pth, file_content):
+    """Collect PubMed IDs of small scale references entry by entry.
+
+    The PubMed IDs of each entry are indexed by the entry's checksum in ENTRY_INDEX. When a file is parsed again
+    after being edited, only the entries whose checksums are not in the index of its previous version are
+    parsed. Indexes are kept for the ENTRY_INDEX_FILES files parsed most recently.
+
+    Args:
+        pth: FileRecord object.
+        file_content (str): File content.
 
     Returns:
-        list (Reference instances)
+        set: PubMed IDs.
+
     """
-    reference_model_list =[]
-    file_model_instance = _get_model_instance(pth)
-    for pmid in new_pmids:
-        reference_model_list.append(_prepare_reference_model_dict(file_model_instance, pmid, True))
-    for pmid in known_pmids:
-        reference_model_list.append(_prepare_reference_model_dict(file_model_instance, pmid, False))
-    return reference_model_list
+    previous = ENTRY_INDEX.pop(pth.location, {})
+    index = {}
+    pmids = set()
+    for entry in _split_entries(file_content):
+        digest = hashlib.md5(entry.encode('latin1')).digest()
+        entry_pmids = index.get(digest)
+        if entry_pmids is None:
+            entry_pmids = previous.get(digest)
+        if entry_pmids is None:
+            entry_pmids = frozenset(_parse_pmids(entry))
+        index[digest] = entry_pmids
+        pmids.update(entry_pmids)
+    if previous:
+        reparsed = len(index.keys() - previous.keys())
+        SAMPLED_LOG.debug('Re-parsed %s of %s distinct entries in %s', reparsed, len(index), pth.location)
+    ENTRY_INDEX[pth.location] = index
+    while len(ENTRY_INDEX) > app.config['ENTRY_INDEX_FILES']:
+        ENTRY_INDEX.popitem(last=False)
+    return pmids
+
+
+def _parse_pmids(file_content):
+    """Collect PubMed IDs of small scale references from entries.
+
+    Args:
+        file_content (str): File content.
 
+    Returns:
+        set: PubMed IDs.
 
-def _prepare_reference_model_dict(file_model_instance, pmid, is_new):
-    return {'pmid': pmid, 'sourcefile': file_model_instance.id, 'is_new': is_new}
+    """
+    pmid_set_tmp = set()
+    rp_tmp = []
+    for line in file_content.split('\n'):
+        prefix, rest = _split2prefix_and_rest(line)
+        if prefix == 'RP':
+            rp_tmp.append(rest)
+        elif prefix == 'RC':
+            pass
+        elif prefix == 'RX':
+            if _is_small_scale_reference(rp_tmp):
+                match = _search4pmid(rest)
+                if match:
+                    pmid = _extract_pmid_from_match(match)
+                    pmid_set_tmp.add(pmid)
+            else:
+                SAMPLED_LOG.warn('Ignored LARGE SCALE ref: %s', rest)
+                SAMPLED_LOG.info('RP tokens for above reference: %s', rp_tmp)
+        else:
+            rp_tmp = []
+    return pmid_set_tmp
 
 
-def _get_model_instance(pth):
-    """Return the File model instance for the given file.
+def _compile_reference_models(new_pmids, known_pmids, file_id):
+    """Prepare lists of Pmid and Reference model dicts which can be added to the DB.
 
     Args:
-        pth (path): path to a file
+        new_pmids (set): gathered PMIDs which are not yet in Swiss-Prot
+        known_pmids (set): gathered PMIDs which are already in Swiss-Prot
+        file_id (int): primary key of the File the PMIDs were extracted from
 
     Returns:
-        File model instance
+        tuple: list of Pmid model dicts, list of Reference model dicts
     """
-    file_model_instance = File.select().where(File.filename == pth.path.name).get()
-    return file_model_instance
+    pmid_model_list = []
+    reference_model_list = []
+    for pmids, in_swissprot in ((new_pmids, False), (known_pmids, True)):
+        for pmid in pmids:
+            pmid_model_list.append({'id': int(pmid), 'in_swissprot': in_swissprot})
+            reference_model_list.append({'pmid': int(pmid), 'sourcefile': file_id})
+    return pmid_model_list, reference_model_list
+
+
+def _delete_orphaned_pmids():
+    """Delete PubMed IDs no file refers to any longer."""
+    referenced = Reference.select().where(Reference.pmid == Pmid.id)
+    deleted = Pmid.delete().where(~peewee.fn.EXISTS(referenced)).execute()
+    if deleted:
+        app.logger.debug('Deleted %s orphaned PMIDs.', deleted)
 
 
 def _log_known_pmids(known_pmids, pth):
@@ -270,7 +1504,7 @@ def _log_known_pmids(known_pmids, pth):
     """
     if known_pmids:
         for item in known_pmids:
-            app.logger.info('Found previously used PMID for file {0}: {1}'.format(pth.path, item))
+            SAMPLED_LOG.info('Found previously used PMID for file %s: %s', pth.path, item)
 
 
 def _compare_pmid_sets(gathered_pmids):
@@ -306,7 +1540,7 @@ def _extract_file_data(pth):
     """Extract metadata of file in path.
 
     Args:
-        pth: WrappedPath object
+        pth: FileRecord object
 
     Returns:
         dict: Dict describing a File model instance.
@@ -315,10 +1549,10 @@ def _extract_file_data(pth):
     file_model_dict = {}
     file_model_dict['filename'] = pth.path.name
     file_model_dict['filetype'] = pth.path.suffix
-    file_model_dict['checksum'] = pth.checksum
+    file_model_dict['checksum'] = pth.checksum.hex()
     file_model_dict['curator'] = _find_curator(pth).id
     file_model_dict['folder'] = _find_folder(pth).id
-    file_model_dict['entry_count'] = _count_entries_in_file(pth)
+    file_model_dict['entry_count'] = _parse_file(pth).entry_count
     file_model_dict['resubmission'] = _check_whether_resubmission(pth)
     return file_model_dict
 
@@ -327,51 +1561,85 @@ def _survey_files_in_folders():
     """Compile checksums for files.
 
     Values are stored in the modules level variable
-    MONITOR_QUEUE.
+    MONITOR_QUEUE. See FolderSurvey for how folders are listed.
     """
     checksum_dict = {}
+    SURVEY.start(MONITOR_QUEUE[-1].values())
     for folder_instance in Folder.select():
-        current_folder = pathlib.Path(folder_instance.path)
-        app.logger.info('Looking at folder: {}'.format(str(current_folder)))
-        if not current_folder.exists():
-            msg = 'There was an error accessing {}'.format(str(current_folder))
+        current_folder = folder_instance.path
+        app.logger.info('Looking at folder: %s', current_folder)
+        if not os.path.isdir(current_folder):
+            msg = 'There was an error accessing {}'.format(current_folder)
             category = 'alert alert-danger'
             # flash(msg, category)
             app.logger.error(msg)
         else:
-            file_list = [WrappedPath(x) for x in current_folder.iterdir() if x.is_file()]
-            for f in file_list:
-                app.logger.info('File: {0} - Checksum: {1}'.format(str(f.path), f.checksum))
+            for f in SURVEY.files(current_folder):
+                SAMPLED_LOG.info('File: %s - Checksum: %s', f.location, f.checksum.hex())
                 checksum_dict[f.checksum] = f
+    SURVEY.finish()
     MONITOR_QUEUE.append(checksum_dict)
 
 
-def _files2delete():
+def _files2delete(keep=frozenset()):
     """Determine which File model instances have to be deleted.
 
+    Args:
+        keep (set): Checksums of files not to delete.
+
     Returns:
         generator (File): File model instance.
     """
-    previous = set(MONITOR_QUEUE[0].keys())
-    current = set(MONITOR_QUEUE[1].keys())
-    for checksum in previous.difference(current):
-        file_model_instance = File.select().where(File.checksum == checksum).get()
+    for checksum in MONITOR_QUEUE[0].keys() - MONITOR_QUEUE[1].keys() - keep:
+        file_model_instance = File.select().where(File.checksum == checksum.hex()).get()
         yield file_model_instance
 
 
-def _delete_obsolete_files():
-    for file_model in _files2delete():
-        app.logger.info('Deleted file from db: {}'.format(file_model.filename))
-        file_model.delete_instance(recursive=True)
+def _modified_files():
+    """Determine which files have been changed in place.
+
+    Returns:
+        dict: Checksums of the current versions mapped to checksums of the previous versions (bytes).
+    """
+    previous = MONITOR_QUEUE[0]
+    current = MONITOR_QUEUE[1]
+    gone = {}
+    for checksum in previous.keys() - current.keys():
+        if previous[checksum] is not None:
+            gone[previous[checksum].location] = checksum
+    modified = {}
+    for checksum in current.keys() - previous.keys():
+        if current[checksum].location in gone:
+            modified[checksum] = gone[current[checksum].location]
+    return modified
+
+
+def _delete_obsolete_files(keep=frozenset()):
+    """Delete File model instances (and their references) for files which are gone or changed.
+
+    Args:
+        keep (set): Checksums of files not to delete, e.g. modified files which are updated instead.
+
+    Returns:
+        int: Number of deleted files.
+    """
+    count = 0
+    # Readers see all of the deletes or none.
+    with db.atomic():
+        for file_model in _files2delete(keep):
+            app.logger.info('Deleted file from db: %s', file_model.filename)
+            file_model.delete_instance(recursive=True)
+            count += 1
+        if count:
+            _new_generation()
+    return count
 
 
 def files2add():
     """Determine which files to add to the database.
 
     Returns:
-        generator (str): pathlib.Path objects.
+        generator (FileRecord): FileRecord objects.
     """
-    previous = set(MONITOR_QUEUE[0].keys())
-    current = set(MONITOR_QUEUE[1].keys())
-    for checksum in current.difference(previous):
+    for checksum in MONITOR_QUEUE[1].keys() - MONITOR_QUEUE[0].keys():
         yield MONITOR_QUEUE[1][checksum]
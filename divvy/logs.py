@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+This module sets up divvy's log so that logging does not hold up scans or requests.
+
+Log records are put on a queue by the thread logging them and written by a background thread (see setup_logging).
+Messages should be passed with %-style arguments, e.g. app.logger.info('Deleted %s', path), so they are only
+formatted if the record is actually logged. Messages logged for every file of a scan go through a LogSampler,
+which logs the first few of each kind per scan and how many more there were.
+"""
+import atexit
+import copy
+import datetime
+import json
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON lines, e.g. for log shippers."""
+    def format(self, record):
+        data = {'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'message': record.getMessage(),
+                'logger': record.name,
+                'thread': record.threadName,
+                'path': record.pathname,
+                'line': record.lineno,
+                }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data)
+
+
+class _QueueHandler(QueueHandler):
+    """Hand records to the listener with their message formatted but without formatting tracebacks.
+
+    The message is formatted in the logging thread as arguments may change once the call returns. Tracebacks are
+    rendered to text so that the record can be passed between threads without holding on to frames. This is done
+    on a copy, leaving the record as it is for any other handlers.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _QueueListener(QueueListener):
+    """QueueListener which may be stopped more than once, e.g. by a script and again at exit."""
+    def stop(self):
+        if self._thread is not None:
+            super(_QueueListener, self).stop()
+
+
+def setup_logging(app):
+    """Send the app's log through a queue to the log file and any handlers the app's logger already has.
+
+    The level of the logger is set to LOG_LEVEL, so messages below it are dropped before being formatted.
+
+    Args:
+        app (Flask): The app whose logger to set up.
+
+    Returns:
+        QueueListener: The listener writing the records; it is stopped when the interpreter exits.
+    """
+    logger = app.logger
+    formatter = JsonFormatter() if app.config['LOG_JSON'] else logging.Formatter(app.config['LOG_FORMAT'])
+    handler = RotatingFileHandler(app.config['LOG_FILE'],
+                                  maxBytes=app.config['LOG_MAXBYTES'],
+                                  backupCount=app.config['LOG_BACKUP_COUNT'])
+    handler.setLevel(app.config['LOG_LEVEL'])
+    handler.setFormatter(formatter)
+    handlers = [handler]
+    for existing in list(logger.handlers):
+        logger.removeHandler(existing)
+        handlers.append(existing)
+    records = queue.Queue(-1)
+    listener = _QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(_QueueHandler(records))
+    logger.setLevel(app.config['LOG_LEVEL'])
+    return listener
+
+
+class LogSampler(object):
+    """Log the first few messages of each kind, summarizing the rest when flushed.
+
+    Messages are told apart by their format string, so they must be logged with %-style arguments.
+
+    Args:
+        logger (logging.Logger): Where to log to.
+        limit (int): Number of messages of each kind logged between flushes.
+    """
+    def __init__(self, logger, limit):
+        self.logger = logger
+        self.limit = limit
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def debug(self, msg, *args):
+        self._log(logging.DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self._log(logging.INFO, msg, args)
+
+    def warn(self, msg, *args):
+        self._log(logging.WARNING, msg, args)
+
+    def _log(self, level, msg, args):
+        if not self.logger.isEnabledFor(level):
+            return
+        with self._lock:
+            count = self._counts[level, msg] = self._counts.get((level, msg), 0) + 1
+        if count <= self.limit:
+            # Attribute the record to the caller of debug, info or warn.
+            self.logger.log(level, msg, *args, stacklevel=3)
+
+    def flush(self):
+        """Log how many messages of each kind were left out and start counting anew."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        for (level, msg), count in counts.items():
+            if count > self.limit:
+                self.logger.log(level, '%s more messages like "%s" were not logged.', count - self.limit, msg)
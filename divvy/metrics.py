@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides counters, gauges and histograms exposed in the Prometheus text format.
+
+Only what divvy needs is implemented, so there is no dependency on prometheus_client. Metrics are kept per
+process: the web server exposes them on /metrics, a separate scanner worker on the port given by --metrics-port.
+"""
+import bisect
+import math
+import threading
+
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metric(object):
+    """Base class of metrics with optional labels.
+
+    Args:
+        name (str): Metric name.
+        documentation (str): Help text.
+        labelnames (tuple): Names of the labels values are kept for.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Return the child metric for label values."""
+        if len(values) != len(self.labelnames):
+            raise ValueError('{0} expects labels {1}'.format(self.name, self.labelnames))
+        key = tuple(str(value) for value in values)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = self._new_child()
+            return self._values[key]
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Yield name suffix, label pairs and value of each sample."""
+        with self._lock:
+            items = list(self._values.items())
+        for key, child in sorted(items):
+            for suffix, extra, value in child.samples():
+                yield suffix, list(zip(self.labelnames, key)) + extra, value
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for suffix, labels, value in self._samples():
+            lines.append('{0}{1}{2} {3}'.format(self.name, suffix, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class _Value(object):
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = float(value)
+
+    def samples(self):
+        return [('', [], self.value)]
+
+
+class Counter(Metric):
+    """Count events. Without labels, inc may be called on the counter itself."""
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """Report a value which may go up and down.
+
+    Args:
+        func (callable): If given, called on each scrape to get the value of a gauge without labels.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.func = func
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _samples(self):
+        if self.func is None:
+            yield from super(Gauge, self)._samples()
+            return
+        value = self.func()
+        if value is not None:
+            yield '', [], value
+
+
+class _Buckets(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            samples.append(('_bucket', [('le', bound)], cumulative))
+        samples.append(('_sum', [], total))
+        samples.append(('_count', [], cumulative))
+        return samples
+
+
+class Histogram(Metric):
+    """Count observed values, e.g. durations, in buckets. Without labels, observe may be called on the histogram."""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+def render():
+    """Render all metrics in the Prometheus text format."""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = _format_value(value) if isinstance(value, float) else str(value)
+        pairs.append('{0}="{1}"'.format(name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')))
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+SCAN_DURATION = Histogram('divvy_scan_duration_seconds', 'Duration of scans.')
+SCAN_PHASE_DURATION = Histogram('divvy_scan_phase_duration_seconds', 'Time scans spent per phase.', ['phase'])
+SCANS = Counter('divvy_scans_total', 'Scans by result.', ['result'])
+SCAN_FILES = Counter('divvy_scan_files_total', 'Files handled by scans by what was done with them.', ['action'])
+SCAN_BYTES = Counter('divvy_scan_bytes_read_total', 'Bytes of files parsed by scans.')
+SCAN_REFERENCES = Counter('divvy_scan_references_written_total', 'References written to the DB by scans.')
+REQUEST_DURATION = Histogram('divvy_http_request_duration_seconds', 'Duration of HTTP requests per route.',
+                             ['endpoint', 'method', 'status'])
+JIRA_COMMENTS = Counter('divvy_jira_comments_total', 'Attempts to add comments to Jira by outcome.', ['outcome'])
@@ -3,25 +3,25 @@
 This module defines the models used to define the database (DB) underlying Divvy as well as most business logic.
 This is done using an ORM, `peewee <http://docs.peewee-orm.com/en/latest/index.html>`_.
 
-Each model corresponds to a table in the DB. There are four models -  Curator, Folder, File and Reference.
+Each model corresponds to a table in the DB. The main models are Curator, Folder, File, Pmid and Reference.
 There are several folders where files relevant to QA can be found.
 Each file will have been authored by a specific curator and will be found in (at least) one folder.
-Each file will also contain zero to many PubMed IDs.
+Each file will also contain zero to many PubMed IDs, each stored once in the Pmid table and linked to files via the
+Reference table. ScanJournal, ParseCache and ScanTask support scanning the folders.
 As files can undergo several iterations of QA, such *resubmissions* are kept track of and filtered out in the UI.
 
-All models that have a corresponding <model>Admin class will be exposed in divvy's admin interface.
+The admin interface exposing the models is set up in divvy.admin.
 """
 from collections import defaultdict
 import datetime
-import netrc
 import os
 import re
 import time
 from flask import flash
-from flask_admin.contrib.peewee import ModelView
-import jira
 import peewee
-from divvy import app, db
+from playhouse.migrate import SqliteMigrator, migrate
+from divvy import app, db, metrics
+from divvy.util import load_jira_credentials
 
 
 class MyBaseModel(peewee.Model):
@@ -74,7 +74,7 @@ class File(MyBaseModel):
         resubmission (bool): Whether a file has been through QA before.
 
     """
-    filename = peewee.CharField(max_length=50)
+    filename = peewee.CharField(max_length=50, index=True)
     filetype = peewee.FixedCharField(max_length=3)
     checksum = peewee.CharField()
     curator = peewee.ForeignKeyField(Curator, backref='submitted_files')
@@ -86,40 +86,211 @@ class File(MyBaseModel):
         return self.filename
 
 
-class Reference(MyBaseModel):
-    """Model a reference as identified by its PubMed ID.
+class Pmid(MyBaseModel):
+    """Model a publication as identified by its PubMed ID.
 
     References which do not have a PubMed ID are ignored although they might be valid publications. This is due to
     the PubMed indexing which does not capture all papers.
 
     Attributes:
-        pmid (str): PubMed identifier, a string of numbers.
+        id (int): PubMed identifier.
+        in_swissprot (bool): Whether the publication is already cited in Swiss-Prot.
+
+    """
+    id = peewee.IntegerField(primary_key=True)
+    in_swissprot = peewee.BooleanField(default=False, index=True)
+
+    def __unicode__(self):
+        return str(self.id)
+
+
+class Reference(MyBaseModel):
+    """Model a reference to a publication made in a file.
+
+    Attributes:
+        pmid (foreign key): Pointer to Pmid table.
         sourcefile (foreign key): Pointer to File table.
-        is_new (bool): Whether a reference is already in Swiss-Prot.
 
     """
-    pmid = peewee.CharField(max_length=20)
+    pmid = peewee.ForeignKeyField(Pmid, backref='references')
     sourcefile = peewee.ForeignKeyField(File, backref='references', on_delete='CASCADE')
-    is_new = peewee.BooleanField()
+
+    class Meta:
+        indexes = ((('sourcefile', 'pmid'), True),)
+
+    def __unicode__(self):
+        return str(self.pmid_id)
+
+
+class ScanJournal(MyBaseModel):
+    """Model a file a running scan has still to commit to the DB.
+
+    Rows are written when a scan plans its work and removed in the same transaction that commits the file.
+    Rows left over at startup therefore belong to an interrupted scan.
+
+    Attributes:
+        checksum (str): Checksum based on file's name and content.
+        path (str): Fully qualified file path.
+        queued (datetime): When the scan planned to process the file.
+
+    """
+    checksum = peewee.CharField(unique=True)
+    path = peewee.CharField()
+    queued = peewee.DateTimeField(default=datetime.datetime.now)
 
     def __unicode__(self):
-        return self.pmid
+        return self.path
+
+
+class ParseCache(MyBaseModel):
+    """Model the result of parsing a file's content.
+
+    Results are keyed on a checksum of the content alone so that files which are moved or renamed need not be
+    parsed again. Least recently used results are evicted once there are more than PARSE_CACHE_SIZE.
+
+    Attributes:
+        content_hash (str): Checksum based on file's content only.
+        entry_count (int): Number of UniProtKB entries contained within the content.
+        curator_initials (str): Initials of the curator who authored the entries, if found.
+        pmids (str): Space-separated PubMed IDs of small scale references.
+        last_used (datetime): When the result was last used.
 
+    """
+    content_hash = peewee.CharField(unique=True)
+    entry_count = peewee.IntegerField()
+    curator_initials = peewee.CharField(max_length=3, null=True)
+    pmids = peewee.TextField()
+    last_used = peewee.DateTimeField(default=datetime.datetime.now, index=True)
 
-class CuratorAdmin(ModelView):
-    pass
+    def __unicode__(self):
+        return self.content_hash
 
 
-class FolderAdmin(ModelView):
-    pass
+class ScanState(MyBaseModel):
+    """Model the state of folder scanning shared by all processes using the DB.
 
+    The table holds a single row. This lets a web process which does not scan itself learn that a scanner
+    worker has published new data and ask it for a refresh.
 
-class FileAdmin(ModelView):
-    pass
+    Attributes:
+        generation (int): Incremented whenever data shown on the index page change, e.g. by each commit of a scan.
+        last_scan (datetime): When the last scan finished.
+        last_scan_started (datetime): When the last finished scan started.
+        refresh_requested (datetime): When a refresh was last requested.
+        rebuild_requested (datetime): When a rebuild of file and reference data was requested, unless done since.
 
+    """
+    generation = peewee.IntegerField(default=0)
+    last_scan = peewee.DateTimeField(null=True)
+    last_scan_started = peewee.DateTimeField(null=True)
+    refresh_requested = peewee.DateTimeField(null=True)
+    rebuild_requested = peewee.DateTimeField(null=True)
+
+    def __unicode__(self):
+        return str(self.generation)
 
-class ReferenceAdmin(ModelView):
-    pass
+
+class Lease(MyBaseModel):
+    """Model a lease granting one process at a time the right to do some work.
+
+    Attributes:
+        name (str): What the lease is for.
+        holder (str): Identifies the process holding the lease.
+        expires (datetime): When the lease runs out unless renewed.
+
+    """
+    name = peewee.CharField(unique=True)
+    holder = peewee.CharField()
+    expires = peewee.DateTimeField()
+
+    def __unicode__(self):
+        return self.name
+
+
+class ScanTask(MyBaseModel):
+    """Model a task in the scan work queue used when SCAN_MODE is 'queue'.
+
+    Each task asks for one folder to be scanned. A scanner worker claims a pending task for TASK_LEASE_SECONDS
+    and renews its lease while it works. Tasks whose lease expires, e.g. because the worker died, are claimed
+    again by another worker.
+
+    Attributes:
+        folder (foreignkey): Pointer to Folder table.
+        status (str): 'pending', 'claimed', 'done' or 'failed'.
+        owner (str): Identifies the worker which claimed the task.
+        lease_expires (datetime): When the claim runs out unless renewed.
+        attempts (int): How often the task has been claimed.
+        created (datetime): When the task was enqueued.
+        finished (datetime): When the task was done or given up.
+        changes (int): Number of files added, modified or deleted by the scan.
+        seconds (float): How long the scan took.
+
+    """
+    folder = peewee.ForeignKeyField(Folder, backref='scan_tasks', on_delete='CASCADE')
+    status = peewee.CharField(default='pending', index=True)
+    owner = peewee.CharField(null=True)
+    lease_expires = peewee.DateTimeField(null=True)
+    attempts = peewee.IntegerField(default=0)
+    created = peewee.DateTimeField(default=datetime.datetime.now)
+    finished = peewee.DateTimeField(null=True)
+    changes = peewee.IntegerField(default=0)
+    seconds = peewee.FloatField(null=True)
+
+    def __unicode__(self):
+        return '{0} ({1})'.format(self.folder.path, self.status)
+
+
+def init_db(reset_scan_data=False):
+    """Create missing tables and migrate old ones.
+
+    If SHADOW_REBUILD is set, left over data are not deleted but rebuilt by the next scan, see
+    jobs.rebuild_scan_data.
+
+    Args:
+        reset_scan_data (bool): Whether to delete file and reference data left over from earlier scans.
+    """
+    if reset_scan_data and not app.config['SHADOW_REBUILD']:
+        db.drop_tables([File, Pmid, Reference, ScanJournal])
+    migrate_reference_table()
+    # Only create the tables if they do not exist.
+    db.create_tables([Curator, Folder, File, Pmid, Reference, ScanJournal, ParseCache, ScanState, Lease, ScanTask],
+                     safe=True)
+    add_missing_columns(ScanState)
+    if reset_scan_data and app.config['SHADOW_REBUILD']:
+        request_rebuild()
+
+
+def add_missing_columns(model):
+    """Add columns for fields which were added to a model after its table was created."""
+    table = model._meta.table_name
+    existing = [c.name for c in db.get_columns(table)]
+    migrator = SqliteMigrator(db)
+    for field in model._meta.sorted_fields:
+        if field.column_name not in existing:
+            app.logger.info('Adding column %s to table %s.', field.column_name, table)
+            migrate(migrator.add_column(table, field.column_name, field))
+
+
+def migrate_reference_table():
+    """Move PubMed IDs from the Reference table of Divvy <= 5.1 into the Pmid table.
+
+    Previously, each Reference row held a PubMed ID as string together with an is_new flag. Now each PubMed ID
+    is a row in the Pmid table and Reference rows only link files and PubMed IDs. Does nothing unless the
+    Reference table still has the old layout.
+    """
+    table = Reference._meta.table_name
+    if not db.table_exists(table) or 'is_new' not in [c.name for c in db.get_columns(table)]:
+        return
+    app.logger.info('Migrating references to the Pmid table.')
+    with db.atomic():
+        db.execute_sql('ALTER TABLE "{0}" RENAME TO "{0}_old"'.format(table))
+        db.create_tables([Pmid, Reference], safe=True)
+        db.execute_sql('INSERT OR IGNORE INTO "{0}" ("id", "in_swissprot") '
+                       'SELECT DISTINCT CAST("pmid" AS INTEGER), NOT "is_new" FROM "{1}_old"'
+                       .format(Pmid._meta.table_name, table))
+        db.execute_sql('INSERT OR IGNORE INTO "{0}" ("pmid_id", "sourcefile_id") '
+                       'SELECT CAST("pmid" AS INTEGER), "sourcefile_id" FROM "{0}_old"'.format(table))
+        db.execute_sql('DROP TABLE "{0}_old"'.format(table))
 
 
 def count_files_in_folders():
@@ -170,23 +341,20 @@ def compile_refs_per_curator(new=True, old=True):
         dict, {given_name: set(PMIDs)}
     """
     ref_by_cur = defaultdict(set)
-    curators = Curator.select()
-    for curator in curators:
-        for file in curator.submitted_files:
-            if not file.resubmission:
-                if new and old:
-                    for ref in file.references:
-                       ref_by_cur[curator.given_name].add(ref.pmid)
-                elif new and not old:
-                    for ref in file.references:
-                        if ref.is_new:
-                            ref_by_cur[curator.given_name].add(ref.pmid)
-                elif old and not new:
-                    for ref in file.references:
-                        if not ref.is_new:
-                            ref_by_cur[curator.given_name].add(ref.pmid)
-                else:
-                    ref_by_cur[curator.given_name] = set()
+    if not (new or old):
+        return ref_by_cur
+    refs = (Reference
+            .select(Curator.given_name, Reference.pmid)
+            .join(File)
+            .join(Curator)
+            .switch(Reference)
+            .join(Pmid)
+            .where(File.resubmission == False)
+            .distinct())
+    if not (new and old):
+        refs = refs.where(Pmid.in_swissprot == old)
+    for given_name, pmid in refs.tuples():
+        ref_by_cur[given_name].add(pmid)
     return ref_by_cur
 
 
@@ -199,30 +367,380 @@ def count_new_references():
     ref_count = (Reference
                  .select(peewee.fn.Count(peewee.fn.Distinct(Reference.pmid)).alias('count'))
                  .join(File)
-                 .where(File.resubmission == False, Reference.is_new == True))
+                 .switch(Reference)
+                 .join(Pmid)
+                 .where(File.resubmission == False, Pmid.in_swissprot == False))
     return ref_count[0].count
 
 
+# Columns of the rows yielded by export_references and export_files
+REFERENCE_EXPORT_COLUMNS = ('pmid', 'is_new', 'curator', 'given_name', 'filename', 'folder', 'resubmission')
+FILE_EXPORT_COLUMNS = ('filename', 'filetype', 'folder', 'curator', 'given_name', 'entry_count', 'resubmission')
+# Rows read from the DB per query of an export
+EXPORT_PAGE_ROWS = 500
+
+
+def export_references(is_new=None, resubmission=None, folder=None, curator=None):
+    """Yield each reference together with the file, folder and curator it belongs to, oldest first.
+
+    Rows are read page by page as they are consumed (see _paged), so memory use does not depend on the number of
+    references.
+
+    Args:
+        is_new (bool): Only PubMed IDs (not) yet cited in Swiss-Prot. Default: all.
+        resubmission (bool): Only references in files which are (not) resubmissions. Default: all.
+        folder (str): Only references in files of the folder with this path. Default: all.
+        curator (str): Only references in files by the curator with these initials. Default: all.
+
+    Returns:
+        iterator: Tuples in the order of REFERENCE_EXPORT_COLUMNS.
+    """
+    query = (Reference
+             .select(Pmid.id, Pmid.in_swissprot, Curator.initial, Curator.given_name, File.filename, Folder.path,
+                     File.resubmission)
+             .join(Pmid)
+             .switch(Reference)
+             .join(File)
+             .join(Curator)
+             .switch(File)
+             .join(Folder))
+    if is_new is not None:
+        query = query.where(Pmid.in_swissprot == (not is_new))
+    query = _filter_export(query, resubmission, folder, curator)
+    for pmid, in_swissprot, initial, given_name, filename, path, resub in _paged(query, Reference.id):
+        yield pmid, not in_swissprot, initial, given_name, filename, path, resub
+
+
+def export_files(is_new=None, resubmission=None, folder=None, curator=None):
+    """Yield each file together with its folder and curator, oldest first.
+
+    Rows are read page by page as they are consumed (see _paged), so memory use does not depend on the number of
+    files.
+
+    Args:
+        is_new (bool): Only files which do (not) cite PubMed IDs not yet in Swiss-Prot. Default: all.
+        resubmission (bool): Only files which are (not) resubmissions. Default: all.
+        folder (str): Only files in the folder with this path. Default: all.
+        curator (str): Only files by the curator with these initials. Default: all.
+
+    Returns:
+        iterator: Tuples in the order of FILE_EXPORT_COLUMNS.
+    """
+    query = (File
+             .select(File.filename, File.filetype, Folder.path, Curator.initial, Curator.given_name,
+                     File.entry_count, File.resubmission)
+             .join(Curator)
+             .switch(File)
+             .join(Folder))
+    if is_new is not None:
+        new_references = (Reference
+                          .select()
+                          .join(Pmid)
+                          .where(Reference.sourcefile == File.id, Pmid.in_swissprot == False))
+        exists = peewee.fn.EXISTS(new_references)
+        query = query.where(exists if is_new else ~exists)
+    query = _filter_export(query, resubmission, folder, curator)
+    return _paged(query, File.id)
+
+
+def _paged(query, key):
+    """Yield the rows of a query as tuples, ordered by a unique key and read EXPORT_PAGE_ROWS at a time.
+
+    Each page is read by a short query of its own (key > last key of the previous page), so no read stays open
+    while the rows are consumed, e.g. by a slow download. In rollback-journal mode an open read would keep
+    the scanner from committing. Rows committed between pages may or may not be included.
+
+    Args:
+        query (peewee.Select): Query of the rows.
+        key (peewee.Field): Unique field to order and page by, e.g. a primary key.
+    """
+    query = query.select_extend(key).order_by(key).limit(EXPORT_PAGE_ROWS)
+    last = None
+    while True:
+        page = query if last is None else query.where(key > last)
+        rows = list(page.tuples())
+        for row in rows:
+            yield row[:-1]
+        if len(rows) < EXPORT_PAGE_ROWS:
+            return
+        last = rows[-1][-1]
+
+
+def _filter_export(query, resubmission, folder, curator):
+    if resubmission is not None:
+        query = query.where(File.resubmission == resubmission)
+    if folder is not None:
+        query = query.where(Folder.path == folder)
+    if curator is not None:
+        query = query.where(Curator.initial == curator)
+    return query
+
+
+def get_scan_state():
+    """Return the ScanState model instance, creating it if necessary."""
+    scan_state, _ = ScanState.get_or_create(id=1)
+    return scan_state
+
+
+def record_scan(changes, started):
+    """Note that a scan has finished, starting a new generation if it changed anything.
+
+    Args:
+        changes (int): Number of files added, modified or deleted by the scan.
+        started (datetime): When the scan started listing folders, or None if unknown. Refreshes requested since
+            are still pending.
+    """
+    get_scan_state()
+    update = {ScanState.last_scan: datetime.datetime.now()}
+    if started is not None:
+        update[ScanState.last_scan_started] = started
+    if changes:
+        update[ScanState.generation] = ScanState.generation + 1
+    ScanState.update(update).where(ScanState.id == 1).execute()
+
+
+def new_generation():
+    """Note that data shown on the index page changed outside of a scan, e.g. in the admin panel."""
+    get_scan_state()
+    ScanState.update(generation=ScanState.generation + 1).where(ScanState.id == 1).execute()
+
+
+def request_refresh():
+    """Ask whichever process scans to do so as soon as possible.
+
+    Returns:
+        datetime: Time of the request.
+    """
+    requested = datetime.datetime.now()
+    get_scan_state()
+    ScanState.update(refresh_requested=requested).where(ScanState.id == 1).execute()
+    return requested
+
+
+def refresh_pending():
+    """Whether a refresh has been requested since the last finished scan started.
+
+    A scan which started before the request may have listed folders before the files to be refreshed were saved,
+    so it does not count.
+    """
+    scan_state = get_scan_state()
+    if scan_state.refresh_requested is None:
+        return False
+    return scan_state.last_scan_started is None or scan_state.refresh_requested > scan_state.last_scan_started
+
+
+def request_rebuild():
+    """Ask whichever process scans to rebuild file and reference data from scratch."""
+    get_scan_state()
+    ScanState.update(rebuild_requested=datetime.datetime.now()).where(ScanState.id == 1).execute()
+
+
+def rebuild_requested():
+    """Return when a rebuild was requested or None if none is pending."""
+    return get_scan_state().rebuild_requested
+
+
+def rebuild_done(requested):
+    """Note that a rebuild has been done unless another one has been requested since it started.
+
+    Args:
+        requested (datetime): When the rebuild which is done was requested.
+    """
+    (ScanState
+     .update(rebuild_requested=None)
+     .where(ScanState.id == 1, ScanState.rebuild_requested == requested)
+     .execute())
+
+
+def acquire_lease(name, holder, seconds):
+    """Acquire or renew a lease unless another holder has a lease which has not yet expired.
+
+    Args:
+        name (str): What the lease is for.
+        holder (str): Identifies the process asking for the lease.
+        seconds (float): How long the lease lasts.
+
+    Returns:
+        bool: Whether the lease is held by holder now.
+    """
+    now = datetime.datetime.now()
+    expires = now + datetime.timedelta(seconds=seconds)
+    with db.atomic():
+        Lease.insert(name=name, holder=holder, expires=expires).on_conflict_ignore().execute()
+        acquired = (Lease
+                    .update(holder=holder, expires=expires)
+                    .where(Lease.name == name, (Lease.holder == holder) | (Lease.expires < now))
+                    .execute())
+    return acquired == 1
+
+
+def release_lease(name, holder):
+    """Let a lease expire at once if it is held by holder."""
+    (Lease
+     .update(expires=datetime.datetime.now())
+     .where(Lease.name == name, Lease.holder == holder)
+     .execute())
+
+
+def enqueue_folder_scans():
+    """Add a pending scan task for each folder which has no task pending or claimed.
+
+    Returns:
+        int: Number of enqueued tasks.
+    """
+    with db.atomic():
+        busy = ScanTask.select(ScanTask.folder).where(ScanTask.status.in_(['pending', 'claimed']))
+        folder_ids = [folder.id for folder in Folder.select(Folder.id).where(Folder.id.not_in(busy))]
+        if folder_ids:
+            ScanTask.insert_many([{'folder': folder_id} for folder_id in folder_ids]).execute()
+    return len(folder_ids)
+
+
+def claim_scan_task(owner, seconds):
+    """Claim the oldest pending task or a claimed task whose lease has expired.
+
+    Tasks which have been claimed SCAN_TASK_ATTEMPTS times already are marked as failed instead.
+
+    Args:
+        owner (str): Identifies the worker claiming the task.
+        seconds (float): How long the claim lasts unless renewed.
+
+    Returns:
+        ScanTask: The claimed task, or None if there is none to claim.
+    """
+    now = datetime.datetime.now()
+    # IMMEDIATE takes the write lock up front so that no two workers claim the same task.
+    with db.atomic('IMMEDIATE'):
+        while True:
+            task = (ScanTask
+                    .select()
+                    .where((ScanTask.status == 'pending') |
+                           ((ScanTask.status == 'claimed') & (ScanTask.lease_expires < now)))
+                    .order_by(ScanTask.created, ScanTask.id)
+                    .first())
+            if task is None:
+                return None
+            if task.status == 'claimed':
+                app.logger.warn('Lease of %s on scan task %s expired.', task.owner, task.id)
+            if task.attempts >= app.config['SCAN_TASK_ATTEMPTS']:
+                app.logger.error('Giving up on scanning folder %s.', task.folder.path)
+                task.status = 'failed'
+                task.finished = now
+                task.save()
+                continue
+            task.status = 'claimed'
+            task.owner = owner
+            task.lease_expires = now + datetime.timedelta(seconds=seconds)
+            task.attempts += 1
+            task.save()
+            return task
+
+
+def renew_scan_task(task_id, owner, seconds):
+    """Extend the claim of owner on a task.
+
+    Returns:
+        bool: False if the task has been claimed by another worker in the meantime.
+    """
+    expires = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    renewed = (ScanTask
+               .update(lease_expires=expires)
+               .where(ScanTask.id == task_id, ScanTask.owner == owner, ScanTask.status == 'claimed')
+               .execute())
+    return renewed == 1
+
+
+def finish_scan_task(task_id, owner, changes=0, seconds=None, failed=False):
+    """Report the outcome of a claimed task.
+
+    Failed tasks become pending again so that another attempt is made. Reports of workers which lost their
+    claim are ignored.
+
+    Args:
+        task_id (int): primary key of the ScanTask
+        owner (str): Identifies the worker which claimed the task.
+        changes (int): Number of files added, modified or deleted by the scan.
+        seconds (float): How long the scan took.
+        failed (bool): Whether the scan failed.
+
+    Returns:
+        bool: Whether the report was accepted.
+    """
+    if failed:
+        update = {ScanTask.status: 'pending', ScanTask.owner: None, ScanTask.lease_expires: None}
+    else:
+        update = {ScanTask.status: 'done', ScanTask.finished: datetime.datetime.now(),
+                  ScanTask.changes: changes, ScanTask.seconds: seconds}
+    reported = (ScanTask
+                .update(update)
+                .where(ScanTask.id == task_id, ScanTask.owner == owner, ScanTask.status == 'claimed')
+                .execute())
+    return reported == 1
+
+
+def scan_tasks_open():
+    """Number of scan tasks pending or claimed."""
+    return ScanTask.select().where(ScanTask.status.in_(['pending', 'claimed'])).count()
+
+
+def scan_tasks_waiting():
+    """Whether there are scan tasks to claim, be it pending ones or ones whose lease has expired."""
+    now = datetime.datetime.now()
+    return (ScanTask
+            .select()
+            .where((ScanTask.status == 'pending') |
+                   ((ScanTask.status == 'claimed') & (ScanTask.lease_expires < now)))
+            .exists())
+
+
+def collect_scan_tasks():
+    """Remove finished tasks from the queue and sum up their results.
+
+    Returns:
+        tuple: Number of files changed by the tasks, longest time a task took (s) and number of failed tasks.
+    """
+    with db.atomic():
+        finished = ScanTask.select().where(ScanTask.status.in_(['done', 'failed']))
+        changes = 0
+        seconds = 0.0
+        failed = 0
+        for task in finished:
+            changes += task.changes
+            seconds = max(seconds, task.seconds or 0.0)
+            failed += task.status == 'failed'
+        ScanTask.delete().where(ScanTask.status.in_(['done', 'failed'])).execute()
+    return changes, seconds, failed
+
+
 def add_jira_comment(comment):
     """Log data to JIRA.
 
-    The JIRA instance, issue and credentials are specified via config.py.
+    The JIRA instance, issue and credentials are specified via config.py. Unless set there or entered when
+    starting Divvy, credentials are looked up in .netrc the first time.
 
     Returns:
         str: An error or a success message.
     """
-    if not app.config['JIRA_PWD']:
+    if not load_jira_credentials(app):
+        metrics.JIRA_COMMENTS.labels('no_credentials').inc()
         return 'Cannot log to Jira. Click here!'
     else:
         try:
+            import jira
             ucr = jira.JIRA(app.config['JIRA_URL'], basic_auth=(app.config['JIRA_USER'],
                                                                 app.config['JIRA_PWD']))
         except:
+            metrics.JIRA_COMMENTS.labels('login_failed').inc()
             return 'Cannot log to Jira. Click here!'
         else:
             app.logger.info('Logged into JIRA')
-            ucr.add_comment(app.config['JIRA_ISSUE'], comment)
-            app.logger.info('Comment added to {}'.format(app.config['JIRA_ISSUE']))
+            try:
+                ucr.add_comment(app.config['JIRA_ISSUE'], comment)
+            except Exception:
+                metrics.JIRA_COMMENTS.labels('failure').inc()
+                raise
+            metrics.JIRA_COMMENTS.labels('success').inc()
+            app.logger.info('Comment added to %s', app.config['JIRA_ISSUE'])
             return 'Jira updated!'
 
 
@@ -264,8 +782,28 @@ def read_old_pmids():
             category = 'alert alert-warning'
     finally:
         app.config['OLD_PMIDS'] = pmid_set
+        if pmid_set:
+            update_swissprot_flags(pmid_set)
         return (msg, category)
 
 
+def update_swissprot_flags(pmid_set):
+    """Mark which PubMed IDs in the Pmid table are already cited in Swiss-Prot.
+
+    Args:
+        pmid_set (set): PubMed IDs (str) cited in Swiss-Prot.
+    """
+    if not Pmid.table_exists():
+        return
+    cited = [row.id for row in Pmid.select(Pmid.id) if str(row.id) in pmid_set]
+    with db.atomic():
+        Pmid.update(in_swissprot=False).execute()
+        for idx in range(0, len(cited), 500):
+            Pmid.update(in_swissprot=True).where(Pmid.id.in_(cited[idx:idx + 500])).execute()
+        # The shadow DB of a rebuild has no ScanState table; swapping it in starts a new generation anyway.
+        if not db.shadowed:
+            new_generation()
+
+
 
 
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides on-demand profiling of scans and requests, controlled from the admin panel.
+
+An admin arms the profiler for the next N scans or requests. Each of them is then run under cProfile and,
+optionally, tracemalloc. Results are written to PROFILE_DIR, where they can be downloaded as .prof files (for use
+with pstats, snakeviz etc.) or viewed as a summary of the top functions. While the profiler is not armed, the only
+cost is checking a counter.
+
+Only scans run in the web server's process can be profiled this way.
+"""
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import threading
+import tracemalloc
+from flask import g, request
+from divvy import app
+
+
+class Profiler(object):
+    """Profile the next few scans or requests.
+
+    Attributes:
+        remaining (dict): Number of scans and requests still to be profiled.
+        memory (bool): Whether to take tracemalloc snapshots as well.
+    """
+    kinds = ('scan', 'request')
+
+    def __init__(self):
+        self.remaining = {kind: 0 for kind in self.kinds}
+        self.memory = False
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def arm(self, kind, count, memory=False):
+        with self._lock:
+            self.remaining[kind] = count
+            self.memory = memory
+
+    def disarm(self):
+        with self._lock:
+            for kind in self.kinds:
+                self.remaining[kind] = 0
+
+    def claim(self, kind):
+        """Whether the next scan or request of a kind is to be profiled, counting it if so."""
+        if not self.remaining[kind]:
+            return False
+        with self._lock:
+            if not self.remaining[kind]:
+                return False
+            self.remaining[kind] -= 1
+            return True
+
+    def call(self, kind, func, *args, **kwargs):
+        """Call func, profiling it if the profiler is armed for kind."""
+        if not self.remaining[kind] or not self.claim(kind):
+            return func(*args, **kwargs)
+        session = self.start(kind)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.stop(session)
+
+    def start(self, kind, label=''):
+        """Start profiling the current thread.
+
+        Returns:
+            tuple: What stop needs to save the results.
+        """
+        memory = self.memory
+        if memory:
+            with self._lock:
+                self._running += 1
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(10)
+        profile = cProfile.Profile()
+        profile.enable()
+        return kind, label, profile, memory
+
+    def stop(self, session):
+        """Stop profiling and write the results to PROFILE_DIR."""
+        kind, label, profile, memory = session
+        profile.disable()
+        directory = profile_dir()
+        os.makedirs(directory, exist_ok=True)
+        stem = '{0}-{1}{2}'.format(kind, datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'),
+                                   '-' + label if label else '')
+        profile.dump_stats(os.path.join(directory, stem + '.prof'))
+        if memory:
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(os.path.join(directory, stem + '.tracemalloc'))
+            with self._lock:
+                self._running -= 1
+                if not self._running:
+                    tracemalloc.stop()
+        app.logger.info('Profiled %s %s, see %s.', kind, label, stem)
+
+
+PROFILER = Profiler()
+
+
+def profile_dir():
+    return os.path.abspath(app.config['PROFILE_DIR'])
+
+
+def list_profiles():
+    """Return the names of the result files in PROFILE_DIR, newest first."""
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    names = [x for x in os.listdir(directory) if x.endswith(('.prof', '.tracemalloc'))]
+    return sorted(names, key=lambda x: os.path.getmtime(os.path.join(directory, x)), reverse=True)
+
+
+def summarize(name, limit=30):
+    """Summarize a result file as text: the top functions by cumulative time or the top allocating lines."""
+    path = os.path.join(profile_dir(), name)
+    if name.endswith('.tracemalloc'):
+        snapshot = tracemalloc.Snapshot.load(path)
+        lines = ['Top {} lines by memory allocated and not freed:'.format(limit), '']
+        lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:limit])
+        return '\n'.join(lines)
+    out = io.StringIO()
+    stats = pstats.Stats(path, stream=out)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+@app.before_request
+def start_request_profile():
+    if PROFILER.remaining['request'] and not _excluded(request.endpoint) and PROFILER.claim('request'):
+        g.profile = PROFILER.start('request', request.endpoint or 'unknown')
+
+
+@app.teardown_request
+def stop_request_profile(exc):
+    session = g.pop('profile', None)
+    if session is not None:
+        PROFILER.stop(session)
+
+
+def _excluded(endpoint):
+    """Whether requests to an endpoint are never profiled, e.g. those of the profiler's admin view."""
+    return endpoint is None or endpoint == 'static' or endpoint.startswith('profiling.')
+
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+This module compresses responses and lets browsers cache static files.
+
+Responses of the types in COMPRESS_MIMETYPES are compressed with brotli, if the brotli package is installed and the
+client accepts it, or else with gzip. Streamed responses, e.g. exports, are compressed chunk by chunk. Static files,
+which Flask sends straight from disk, are read into memory to be compressed.
+
+URLs of static files built with url_for carry a fingerprint of the file's content, e.g. /static/style.css?v=1a2b3c4d.
+Requests with a fingerprint are answered with a far-future Cache-Control header; as the URL changes with the content,
+browsers never use an outdated copy.
+"""
+import gzip
+import hashlib
+import os
+import zlib
+from flask import request
+from divvy import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Static file name mapped to modification time and fingerprint
+_FINGERPRINTS = {}
+
+
+def fingerprint(filename):
+    """Return a short hash of a static file's content, or None if there is no such file."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _FINGERPRINTS.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.md5(f.read()).hexdigest()[:8])
+        _FINGERPRINTS[filename] = cached
+    return cached[1]
+
+
+@app.url_defaults
+def add_fingerprint(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = fingerprint(values['filename'])
+        if version is not None:
+            values['v'] = version
+
+
+@app.after_request
+def cache_static(response):
+    """Let browsers keep static files requested with a fingerprint."""
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config['STATIC_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+@app.after_request
+def compress(response):
+    """Compress the response if it is worth it and the client accepts it."""
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']
+            or (response.direct_passthrough and request.endpoint != 'static')):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = _choose_encoding()
+    if encoding is None:
+        return response
+    if response.direct_passthrough:
+        response.direct_passthrough = False
+        response.make_sequence()
+    if response.is_streamed:
+        original = response.response
+        response.response = _compress_chunks(response.iter_encoded(), encoding)
+        if hasattr(original, 'close'):
+            response.call_on_close(original.close)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=app.config['BROTLI_QUALITY']))
+        else:
+            response.set_data(gzip.compress(data, app.config['GZIP_LEVEL']))
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        # The compressed body differs byte for byte from the one the tag was made for.
+        response.set_etag(etag, weak=True)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def _choose_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress_chunks(chunks, encoding):
+    """Compress chunks, flushing after each so that the client gets them as they are produced."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=app.config['BROTLI_QUALITY'])
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(app.config['GZIP_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
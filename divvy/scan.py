@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Scan folders once from the command line.
+
+Started via the console script ``divvy-scan``, this module runs a single scan against a database without starting
+the web server or asking for Jira credentials, then prints how long each phase of the scan took and how much it
+processed. Use it to pre-warm a database, e.g. from cron, to benchmark scans on copies of production folders or
+to find out why scans are slow.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+
+def report(stats, changes):
+    """Compile a report of a scan.
+
+    Args:
+        stats (ScanStats): Stats of the scan.
+        changes (int): Number of files added, modified or deleted by the scan.
+
+    Returns:
+        dict: Seconds per phase, counts and throughput.
+    """
+    seconds = stats.seconds or 0.0
+    files = stats.counts.get('files parsed', 0)
+    nbytes = stats.counts.get('bytes parsed', 0)
+    return {'seconds': round(seconds, 3),
+            'changes': changes,
+            'phases': {name: round(value, 3) for name, value in stats.phases.items()},
+            'counts': dict(stats.counts),
+            'files per second': round(files / seconds, 1) if seconds else None,
+            'MB per second': round(nbytes / seconds / 2**20, 2) if seconds else None,
+            }
+
+
+def print_report(result, out=sys.stdout):
+    """Print a report compiled by report as text."""
+    print('Scan took {0:.3f} s and changed {1} files.'.format(result['seconds'], result['changes']), file=out)
+    print('\nPhase          Seconds   Share', file=out)
+    for name, seconds in result['phases'].items():
+        share = seconds / result['seconds'] if result['seconds'] else 0
+        print('{0:<14}{1:>8.3f}{2:>8.0%}'.format(name, seconds, share), file=out)
+    print('\nCounts', file=out)
+    for name, count in result['counts'].items():
+        print('{0:<22}{1:>10}'.format(name, count), file=out)
+    if result['files per second'] is not None:
+        print('\nThroughput: {0} files/s, {1} MB/s'.format(result['files per second'], result['MB per second']),
+              file=out)
+
+
+def main():
+    """Main entry point for console script."""
+    parser = argparse.ArgumentParser(description='Scan Divvy folders once and report timings and counts.')
+    parser.add_argument('-d', '--database', help='SQLite DB file to scan into (default: DATABASE_URI)')
+    parser.add_argument('-c', '--config', help='Python file with settings overriding the default configuration')
+    parser.add_argument('--reset', action='store_true', help='rebuild file and reference data from scratch')
+    parser.add_argument('--no-budget', action='store_true',
+                        help='ignore SCAN_TIME_BUDGET and SCAN_BYTE_BUDGET and process all new files')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+    if args.config:
+        # The app, its log and the DB are set up on first import of divvy's modules, which must see the settings.
+        os.environ['DIVVY_SETTINGS'] = os.path.abspath(args.config)
+    from divvy import app, db
+    from divvy.jobs import LEADER, ScanStats, rebuild_scan_data, scan_folders
+    from divvy.models import init_db, rebuild_done, rebuild_requested, record_scan
+    if args.database:
+        app.config['DATABASE_URI'] = args.database
+    if args.no_budget:
+        app.config['SCAN_TIME_BUDGET'] = None
+        app.config['SCAN_BYTE_BUDGET'] = None
+    db.init(app.config['DATABASE_URI'])
+    init_db(reset_scan_data=args.reset)
+    if not LEADER.is_leader():
+        sys.exit('Another process holds the scanner lease. Stop it or set LEADER_ELECTION = False.')
+    started = datetime.datetime.now()
+    try:
+        requested = rebuild_requested() if app.config['SHADOW_REBUILD'] else None
+        if requested is not None:
+            changes = rebuild_scan_data()
+            rebuild_done(requested)
+        else:
+            changes = scan_folders()
+        record_scan(changes, started)
+    finally:
+        LEADER.release()
+    result = report(ScanStats.latest, changes)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == '__main__':
+    main()
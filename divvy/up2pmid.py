@@ -58,6 +58,28 @@ def cleanup_match(match, fmt):
         return match[27:]
 
 
+def extract_pmids(paths, fmt):
+    """Extract PubMed IDs from files.
+
+    Args:
+        paths (iterable): Paths of files containing UniProt data.
+        fmt (str): Three letter file format specification (extension)
+
+    Returns:
+        set: PubMed IDs (str)
+
+    """
+    regex = format2regex(fmt)
+    pmid_set = set()
+    for file in paths:
+        with open(file, 'r', encoding='utf8') as f:
+            content = f.read()
+            for match in re.findall(regex, content):
+                pmid = cleanup_match(match, fmt)
+                pmid_set.add(pmid)
+    return pmid_set
+
+
 def main():
     """Main entry point for console script.
 
@@ -78,14 +100,7 @@ def main():
     parser.add_argument('-f', '--format', default='txt', help='format of UniProt data (txt/xml/rdf)')
     parser.add_argument('-o', '--output', help='output file the extracted Ids can be saved to')
     args = parser.parse_args()
-    regex = format2regex(args.format)
-    pmid_set = set()
-    for file in glob.glob(args.path):
-        with open(file, 'r', encoding='utf8') as f:
-            content = f.read()
-            for match in re.findall(regex, content):
-                pmid = cleanup_match(match, args.format)
-                pmid_set.add(pmid)
+    pmid_set = extract_pmids(glob.glob(args.path), args.format)
     if args.output:
         with open(args.output, 'w', encoding='utf8') as f:
             for pmid in pmid_set:
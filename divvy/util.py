@@ -17,6 +17,31 @@ def get_jira_credentials(app):
             print('Assigned files can be manually copied.')
 
 
+def load_jira_credentials(app):
+    """Look up Jira credentials in .netrc once, unless they are known already.
+
+    Unlike get_jira_credentials, this never asks for a password. It is called when Jira is
+    first used, so that starting Divvy does not wait for credentials.
+
+    Returns:
+        bool: Whether credentials are available.
+    """
+    if not app.config['JIRA_PWD'] and not app.config.get('JIRA_NETRC_CHECKED'):
+        app.config['JIRA_NETRC_CHECKED'] = True
+        _get_jira_credentials_from_netrc(app)
+    return bool(app.config['JIRA_PWD'])
+
+
+def is_debug_client(app):
+    """Whether the current request comes from a client allowed to use the debugging tools.
+
+    Profiles and recorded SQL statements show file paths, source lines and query parameters, so the
+    profiling admin view and /_debug/queries are only served to clients listed in DEBUG_CLIENTS.
+    """
+    from flask import request
+    return request.remote_addr in app.config['DEBUG_CLIENTS']
+
+
 def _get_jira_credentials_from_netrc(app):
     """Try to retrieve a user name and password for Jira from .netrc."""
     try:
@@ -2,17 +2,31 @@
 """
 This module provides are the routes in divvy.
 """
+from contextlib import nullcontext
+import csv
+import io
 import json
 from json import JSONDecodeError
+import time
 from flask import (
+    Response,
+    abort,
     flash,
+    g,
     jsonify,
+    make_response,
     redirect,
     render_template,
     request,
+    session,
+    stream_with_context,
     url_for,
     )
-from divvy import app
+from divvy import app, db, metrics
+from divvy.util import is_debug_client
+from divvy.version import __version__
+from divvy import responses  # Compresses responses and caches static files
+from .jobs import LEADER, SURVEY, await_worker_scan, last_scan_failed, scan_now
 from .models import *
 
 
@@ -21,25 +35,42 @@ def index():
     """Render the index page.
 
     For data to be rendered, they have to be in the database first. Database population is provided via the refresh route.
+    With SHADOW_REBUILD, which puts the DB in WAL mode, all data are read in one transaction so that the page shows
+    a consistent snapshot even while a scan writes. Otherwise a read transaction would hold up the scanner's commits
+    for as long as the page renders.
+
+    The page is tagged with the data generation (see ScanState), so browsers which have it already are answered
+    with 304 Not Modified until a scan, the admin panel or a reload of PubMed IDs changes the data.
 
     """
-    curators = Curator.select()
-    checkers = Curator.select().where(Curator.checker == True)
-    fldrs = Folder.select()
-    ref_by_cur = compile_refs_per_curator(new=True, old=False)
-    ref_by_cur_known = compile_refs_per_curator(new=False, old=True)
-    ref_count = count_new_references()
-    folder_count = count_files_in_folders()
-    return render_template('index.html',
-                           checkers=checkers,
-                           curators=curators,
-                           folders=fldrs,
-                           ref_by_cur=ref_by_cur,
-                           ref_by_cur_known=ref_by_cur_known,
-                           folder_count=folder_count,
-                           jira=app.config['JIRA_ISSUE'],
-                           jira_url=app.config['JIRA_URL'],
-                           ref_count=ref_count)
+    etag = '{}-{}'.format(__version__, get_scan_state().generation)
+    # Pages showing flashed messages are neither cached nor answered from cache.
+    cacheable = '_flashes' not in session
+    if cacheable and request.if_none_match.contains_weak(etag):
+        return '', 304
+    with db.atomic() if app.config['SHADOW_REBUILD'] else nullcontext():
+        curators = Curator.select()
+        checkers = Curator.select().where(Curator.checker == True)
+        fldrs = Folder.select()
+        ref_by_cur = compile_refs_per_curator(new=True, old=False)
+        ref_by_cur_known = compile_refs_per_curator(new=False, old=True)
+        ref_count = count_new_references()
+        folder_count = count_files_in_folders()
+        page = render_template('index.html',
+                               checkers=checkers,
+                               curators=curators,
+                               folders=fldrs,
+                               ref_by_cur=ref_by_cur,
+                               ref_by_cur_known=ref_by_cur_known,
+                               folder_count=folder_count,
+                               jira=app.config['JIRA_ISSUE'],
+                               jira_url=app.config['JIRA_URL'],
+                               ref_count=ref_count)
+    response = make_response(page)
+    if cacheable:
+        response.set_etag(etag, weak=True)
+        response.cache_control.no_cache = True
+    return response
 
 
 @app.route("/admin/reload_pmid", methods=['GET', 'POST'])
@@ -54,20 +85,25 @@ def reload_pmid():
 def refresh():
     """Refresh the file and reference contents of the database.
 
-    See scan_folders for how this is done.
+    See scan_folders for how this is done. The scan runs in a background thread, which the request waits for up to
+    REFRESH_TIMEOUT. Refreshes arriving while a scan is running (triggered by another refresh or the scheduler)
+    wait for that scan rather than starting another one. If scanning is left to a separate scanner worker or
+    another process is the scanner leader, that process is asked for a scan instead.
 
     Returns:
         redirect: To index.
 
     """
-    # try:
-    #     time_since_refresh = datetime.datetime.now() - app.config['OLD_PMIDS_FILE_MODIFIED']
-    # except KeyError:
-    #     time_since_refresh = datetime.datetime.now() - datetime.datetime(2016, 1, 1)
-    # if not app.config.get('OLD_PMIDS') or time_since_refresh > datetime.timedelta(1):
-    #     msg, category = read_old_pmids()
-    #     flash(msg, category)
-    # scan_folders()
+    if app.config['SCAN_IN_WEB'] and app.config['SCAN_MODE'] == 'single' and LEADER.is_leader():
+        # Files edited in place may sit in directories whose listing is reused, see FolderSurvey.
+        SURVEY.request_full()
+        done = scan_now(timeout=app.config['REFRESH_TIMEOUT'])
+        if done and last_scan_failed():
+            flash('The scan failed. See the log for details.', 'alert alert-danger')
+    else:
+        done = await_worker_scan(timeout=app.config['REFRESH_TIMEOUT'])
+    if not done:
+        flash('A scan is in progress. Refresh again shortly to see its results.', 'alert alert-info')
     return redirect(url_for('index'))
 
 
@@ -81,7 +117,7 @@ def log_files():
     """
     files = request.args.get('files', 'None received')
     app.logger.info(type(files))
-    app.logger.info('Received json for _send_mail ' + files)
+    app.logger.info('Received json for _send_mail %s', files)
     if not files or files == 'None received':
         result = 'No files received! Take a look at the logs!'
         status = "danger"
@@ -110,4 +146,130 @@ def log_files():
             jira_comment = '\n'.join(comments)
             result = add_jira_comment(jira_comment)
             status = "success"
-    return jsonify(result=result, log=jira_comment, status=status)
\ No newline at end of file
+    return jsonify(result=result, log=jira_comment, status=status)
+
+
+# Data sets which can be exported: columns and function yielding the rows
+EXPORTS = {'references': (REFERENCE_EXPORT_COLUMNS, export_references),
+           'files': (FILE_EXPORT_COLUMNS, export_files),
+           }
+
+# Rows written per chunk of a streamed export
+EXPORT_CHUNK_ROWS = 500
+
+
+@app.route('/export/<dataset>.<fmt>')
+def export(dataset, fmt):
+    """Stream references or files, with the folder and curator they belong to, as CSV or JSON.
+
+    The query parameters is_new, resubmission (both true or false), folder (path) and curator (initials) filter the
+    rows. The response is written while rows are read from the DB, so memory use stays flat however many rows there are.
+
+    Returns:
+        Response: The rows as a file to download.
+
+    """
+    if dataset not in EXPORTS or fmt not in ('csv', 'json'):
+        abort(404)
+    columns, select = EXPORTS[dataset]
+    rows = select(is_new=_bool_arg('is_new'),
+                  resubmission=_bool_arg('resubmission'),
+                  folder=request.args.get('folder'),
+                  curator=request.args.get('curator'))
+    if fmt == 'csv':
+        chunks, mimetype = _csv_chunks(columns, rows), 'text/csv'
+    else:
+        chunks, mimetype = _json_chunks(columns, rows), 'application/json'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=divvy-{0}.{1}'.format(dataset, fmt)
+    return response
+
+
+def _bool_arg(name):
+    """Return a query parameter as bool, or None if it is missing."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    abort(400)
+
+
+def _csv_chunks(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _json_chunks(columns, rows):
+    """Yield a JSON array of objects, one per row."""
+    yield '['
+    separator = '\n'
+    parts = []
+    for row in rows:
+        parts.append(separator + json.dumps(dict(zip(columns, row))))
+        separator = ',\n'
+        if len(parts) == EXPORT_CHUNK_ROWS:
+            yield ''.join(parts)
+            parts = []
+    yield ''.join(parts) + '\n]\n'
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Expose scan, request and Jira metrics in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_duration(response):
+    """Add the duration of a request to the metrics, labelled with the route rather than the URL."""
+    start = g.pop('request_start', None)
+    if start is not None:
+        (metrics.REQUEST_DURATION
+         .labels(request.endpoint or 'unknown', request.method, response.status_code)
+         .observe(time.perf_counter() - start))
+    return response
+
+
+@app.route('/_debug/queries')
+def query_logs():
+    """Show the SQL statements of recent requests and scans if SQL_INSTRUMENTATION is set.
+
+    They include parameters such as file paths and curator names, so only clients in DEBUG_CLIENTS see them.
+    """
+    if not app.config['SQL_INSTRUMENTATION'] or not is_debug_client(app):
+        abort(404)
+    # Requests and scans keep adding logs while the page renders, so it works on a copy.
+    return render_template('queries.html',
+                           logs=list(db.query_logs)[::-1],
+                           threshold=app.config['SQL_REPEATED_QUERY_THRESHOLD'])
+
+
+@app.before_request
+def start_query_log():
+    if app.config['SQL_INSTRUMENTATION'] and request.endpoint not in ('static', 'query_logs'):
+        g.query_log = db.start_query_log('{0} {1}'.format(request.method, request.path),
+                                         app.config['SQL_SLOW_QUERY_SECONDS'])
+
+
+@app.teardown_request
+def stop_query_log(exc):
+    log = g.pop('query_log', None)
+    if log is not None:
+        db.stop_query_log(log)
+        log.log_findings(app.logger, app.config['SQL_REPEATED_QUERY_THRESHOLD'])
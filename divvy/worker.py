@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Scan folders in a process of its own.
+
+Parsing files is CPU-heavy. Running the scans in the web server's process makes page requests compete with them
+for the GIL. Started via the console script ``divvy-scanner``, this module scans on the adaptive schedule and
+whenever a web process asks for a refresh, writing to the DB shared with the web processes.
+Web processes should then be configured with SCAN_IN_WEB = False. Several workers may run; only the one holding
+the scanner lease scans (see jobs.LeaderElection).
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import signal
+import sys
+import threading
+import time
+from divvy import app, metrics
+from divvy.jobs import LEADER, scheduled_scan
+from divvy.models import init_db
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the worker's metrics on /metrics, as the web server does for its own."""
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        app.logger.debug('Metrics request: ' + format, *args)
+
+
+def serve_metrics(port):
+    """Serve metrics in a background thread."""
+    server = ThreadingHTTPServer((app.config['HOST'], port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='divvy-metrics', daemon=True).start()
+    app.logger.info('Serving metrics on port %s.', port)
+
+
+def main():
+    """Main entry point for console script."""
+    parser = argparse.ArgumentParser(description='Scan Divvy folders in a process of its own.')
+    parser.add_argument('-t', '--tick', type=float, default=1.0,
+                        help='seconds between checks whether a scan is due or has been requested')
+    parser.add_argument('--metrics-port', type=int, help='serve metrics in the Prometheus text format on this port')
+    args = parser.parse_args()
+    init_db(reset_scan_data=not app.config['SCAN_RESUME'])
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.logger.info('Scanner worker started.')
+    try:
+        while True:
+            scheduled_scan()
+            time.sleep(args.tick)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        LEADER.release()
+        app.logger.info('Scanner worker stopped.')
+
+
+if __name__ == '__main__':
+    main()
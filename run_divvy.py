@@ -5,30 +5,34 @@ Tying it all together.
 
 @author: kp14
 """
-import flask_admin as admin
+import sys
 from flask_apscheduler import APScheduler
 from waitress import serve
 from divvy import app, db
+from divvy.admin import setup_admin
 from divvy.models import *
+from divvy.util import get_jira_credentials
 from divvy.views import *
 
 
-admin = admin.Admin(app, name='Divvy:admin')
-admin.add_view(CuratorAdmin(Curator))
-admin.add_view(FolderAdmin(Folder))
-admin.add_view(FileAdmin(File))
-admin.add_view(ReferenceAdmin(Reference))
+admin = setup_admin(app)
 
-# Delete any leftover file and reference data
-db.drop_tables([File, Reference])
-# Only create the tables if they do not exist.
-db.create_tables([Curator, Folder, File, Reference], safe=True)
+# Delete any leftover file and reference data unless an interrupted scan is to be resumed.
+# If a separate scanner worker scans, this is left to the worker.
+init_db(reset_scan_data=app.config['SCAN_IN_WEB'] and not app.config['SCAN_RESUME'])
 
 if __name__ == "__main__":
-    scheduler = APScheduler()
-    scheduler.init_app(app)
-    scheduler.start()
+    if sys.stdin.isatty():
+        # Ask for a password if .netrc has none. Otherwise .netrc is only read once Jira is first used.
+        get_jira_credentials(app)
+    if app.config['SCAN_IN_WEB']:
+        scheduler = APScheduler()
+        scheduler.init_app(app)
+        scheduler.start()
     serve(app,
           host=app.config['HOST'],
           port=app.config['PORT'],
+          threads=app.config['WAITRESS_THREADS'],
+          connection_limit=app.config['WAITRESS_CONNECTION_LIMIT'],
+          backlog=app.config['WAITRESS_BACKLOG'],
           )
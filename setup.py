@@ -12,9 +12,10 @@ setup(
     license='public domain',
     classifiers=[
         'Development Status :: 5 - Production/Stable',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.8',
     ],
-    packages=find_packages(exclude=['docs']),
+    python_requires='>=3.8',
+    packages=find_packages(exclude=['docs', 'benchmarks', 'benchmarks.*']),
     install_requires=['flask',
                       'flask-admin>=1.5.1',
                       'apscheduler',
@@ -25,12 +26,19 @@ setup(
                       'pbr',
                       'waitress',
                       ],
+    extras_require={'brotli': ['brotli']},
     package_data={'divvy': ['static/favicon.ico',
                             'templates/base.html',
                             'templates/index.html',
+                            'templates/queries.html',
                             'templates/admin/index.html',
+                            'templates/admin/profiling.html',
+                            'templates/admin/profile.html',
                             ],
                   },
-    entry_points = {'console_scripts': ['up2pmid=divvy.up2pmid:main']},
+    entry_points = {'console_scripts': ['up2pmid=divvy.up2pmid:main',
+                                        'divvy-scanner=divvy.worker:main',
+                                        'divvy-scan=divvy.scan:main',
+                                        ]},
     scripts=['run_divvy.py'],
 )
\ No newline at end of file